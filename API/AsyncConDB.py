@@ -0,0 +1,492 @@
+#
+# asyncio version of the ConDB client API, uses psycopg 3 and psycopg_pool
+#
+# AsyncConDB, AsyncCDTable and AsyncCDSnapshot have the same methods as ConDB, CDTable and CDSnapshot.
+# Methods doing I/O are coroutines, iterators are async generators.
+# Queries run on connections checked out of a pool, so independent queries can run concurrently.
+# SQL building and the snapshot list algorithms are shared with the ConDB module.
+#
+
+import asyncio, itertools
+from psycopg_pool import AsyncConnectionPool
+
+from ConDB import CDTable, CDSnapshot, merge_by_channel, purge_updates
+
+async def async_merge_by_channel(data, updates):
+    # async version of merge_by_channel()
+    # data, updates: async iterators [(channel, tv, data, ...),...], ordered by channel, one tuple per channel
+    async def next_or_none(it):
+        try:    return await it.__anext__()
+        except StopAsyncIteration:  return None
+    data = data.__aiter__()
+    updates = updates.__aiter__()
+    d = await next_or_none(data)
+    u = await next_or_none(updates)
+    while d is not None or u is not None:
+        if u is None or (d is not None and d[0] < u[0]):
+            yield d
+            d = await next_or_none(data)
+        else:
+            if d is not None and d[0] == u[0]:
+                d = await next_or_none(data)
+            yield u
+            u = await next_or_none(updates)
+
+class AsyncConDB:
+
+    CursorNumbers = itertools.count(1)      # to generate unique server side cursor names
+
+    IterSize = 10000        # default number of rows fetched at once from server side cursors
+
+    def __init__(self, connstr, min_size=1, max_size=10, itersize=None):
+        self.ConnStr = connstr
+        self.Pool = AsyncConnectionPool(connstr, min_size=min_size, max_size=max_size, open=False)
+        self.IterSize = itersize or self.IterSize
+
+    async def open(self):
+        await self.Pool.open()
+        return self
+
+    async def close(self):
+        await self.Pool.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, et, ev, tb):
+        await self.close()
+
+    @staticmethod
+    def tableSQL(table, sql):
+        table_no_ns = table.split('.')[-1]
+        return sql.replace('%t', table).replace('%T', table_no_ns)
+
+    async def execute(self, table, sql, args=()):
+        # runs the statement in its own transaction
+        # returns [row,...], or None for statements which do not return rows
+        async with self.Pool.connection() as conn:
+            c = await conn.execute(self.tableSQL(table, sql), args)
+            return await c.fetchall() if c.description else None
+
+    async def executeBatch(self, table, statements):
+        # statements: [(sql, args),...], executed in one transaction
+        async with self.Pool.connection() as conn:
+            async with conn.transaction():
+                for sql, args in statements:
+                    await conn.execute(self.tableSQL(table, sql), args)
+
+    async def iterate(self, table, sql, args=(), conn=None):
+        # returns async iterator [row,...], rows are fetched from a server side cursor in batches
+        # conn: connection already checked out by the caller, e.g. to read several cursors on one connection
+        if conn is None:
+            async with self.Pool.connection() as conn:
+                async for row in self.iterate(table, sql, args, conn):
+                    yield row
+            return
+        async with conn.cursor(name = "condb_cursor_%d" % (next(self.CursorNumbers),)) as c:
+            c.itersize = self.IterSize
+            await c.execute(self.tableSQL(table, sql), args)
+            async for row in c:
+                yield row
+
+    async def copy_from(self, table, rows, table_template, columns):
+        # rows: [(value, ...),...]
+        table = table_template.replace('%t', table)
+        assert "'" not in table
+        columns = ','.join(columns)
+        async with self.Pool.connection() as conn:
+            async with conn.cursor() as c:
+                async with c.copy("copy %s (%s) from stdin" % (table, columns)) as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+
+    def table(self, name, columns):
+        return AsyncCDTable(self, name, columns)
+
+    async def tableFromDB(self, name):
+        words = name.split('.', 1)
+        ns, tname = ('public', name) if len(words) < 2 else tuple(words)
+        rows = await self.execute(name, """select column_name from information_schema.columns
+                        where table_schema = %s and table_name = %s
+                        order by ordinal_position""", (ns, tname + "_update"))
+        columns = [r[0] for r in rows if r[0] not in ("__snapshot_id", "__tv", "__channel", "__tr")]
+        if not columns:
+            return None
+        return AsyncCDTable(self, name, columns)
+
+class AsyncCDSnapshot:
+
+    def __init__(self, table, snapshot_id, tv = None, tr = None):
+        self.Table = table
+        self.Id = snapshot_id
+        self.Tv = tv
+        self.Tv_end = None
+        self.Tr = tr
+        self.Deleted = None
+        self.DataType = None
+        self.InfoFetched = False
+
+    def __str__(self):
+        return '<AsyncCDSnapshot id=%s type=%s tr=%s tv=%s tvend=%s deleted=%s>' % \
+            (self.Id, self.DataType, self.Tr, self.Tv, self.Tv_end or "-", self.Deleted)
+
+    __repr__ = __str__
+
+    @staticmethod
+    def fromInfo(table, tup):
+        # tup: (id, tv, tv_end, tr, deleted, type) as selected with CDSnapshot.infoColumns()
+        s = AsyncCDSnapshot(table, tup[0])
+        s.Tv, s.Tv_end, s.Tr, s.Deleted, s.DataType = tup[1:6]
+        s.InfoFetched = True
+        return s
+
+    @staticmethod
+    async def create(table, tv, data_type, tv_end = None):
+        rows = await table.execute("""insert into %t_snapshot(__tv, __type, __tv_end)
+                values(%s, %s, %s)
+                returning """ + CDSnapshot.infoColumns(), (tv, data_type, tv_end))
+        return AsyncCDSnapshot.fromInfo(table, rows[0])
+
+    async def fetchInfo(self):
+        if not self.InfoFetched:
+            rows = await self.Table.execute("select " + CDSnapshot.infoColumns() +
+                        " from %t_snapshot where __id=%s", (self.Id,))
+            self.Tv, self.Tv_end, self.Tr, self.Deleted, self.DataType = rows[0][1:6]
+            self.InfoFetched = True
+        return self
+
+    async def tags(self):
+        rows = await self.Table.execute("""select __tag_name from %t_tag_snapshot
+                                where __snapshot_id = %s""", (self.Id,))
+        return [x[0] for x in rows]
+
+    async def latestUpdate(self):
+        rows = await self.Table.execute("""select max(__tv) from %t_update
+                where __snapshot_id=%s""", (self.Id,))
+        return rows[0][0] if rows else None
+
+    async def getUpdateCount(self):
+        rows = await self.Table.execute("""select count(*) from %t_update
+                    where __snapshot_id=%s""", (self.Id,))
+        return rows[0][0] if rows else 0
+
+    async def getData(self, channel_range = None, conditions = [], channels = None, columns = None, conn = None):
+        # returns async iterator [(channel, tv, data, ...)] ordered by channel
+        # conn: connection to read from, see AsyncConDB.iterate()
+        await self.fetchInfo()
+        data_columns = self.Table.dataColumns(columns)
+        filter_where, filter_args = self.Table.filterSQL(channel_range=channel_range, conditions=conditions,
+                                    channels=channels)
+        sql = "select " + ','.join(["__channel"] + data_columns) + """ from %t_snapshot_data
+                                where __snapshot_id = %s""" + filter_where + \
+                                " order by __channel"
+        async for tup in self.Table.iterate(sql, [self.Id] + filter_args, conn):
+            yield (tup[0], self.Tv) + tuple(tup[1:])
+
+    async def getUpdatesForTime(self, tv, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None, conn = None):
+        # returns async iterator [(channel,tv,data,...),...] ordered by channel
+        # conn: connection to read from, see AsyncConDB.iterate()
+        data_columns = self.Table.dataColumns(columns)
+        filter_where, filter_args = self.Table.filterSQL(tr=tr, channel_range=channel_range,
+                                    conditions=conditions, channels=channels)
+        sql = "select distinct on (__channel) " + ','.join(["__channel, __tv"] + data_columns) + """
+                                from %t_update
+                                where __snapshot_id = %s
+                                    and __tv <= %s """ + filter_where + \
+                                    " order by __channel, __tr desc, __tv desc"
+        async for tup in self.Table.iterate(sql, [self.Id, tv] + filter_args, conn):
+            yield tuple(tup)
+
+    async def getValuesIter(self, t, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # returns async iterator [(channel, tv, data, ...),...] ordered by channel
+        # snapshot data and updates are read with two cursors on one connection, so that concurrent
+        # iterators can not use up the pool waiting for their second connection
+        await self.fetchInfo()
+        async with self.Table.DB.Pool.connection() as conn:
+            data = self.getData(channel_range=channel_range, conditions=conditions, channels=channels,
+                                    columns=columns, conn=conn)
+            updates = self.getUpdatesForTime(t, tr=tr, channel_range=channel_range, conditions=conditions,
+                                    channels=channels, columns=columns, conn=conn)
+            async for tup in async_merge_by_channel(data, updates):
+                yield tup
+
+    async def getValues(self, t):
+        # returns {channel: (tv, data),...}
+        return dict([(tup[0], (tup[1], tup[2:])) async for tup in self.getValuesIter(t)])
+
+    async def getUpdatesInRange(self, tmin, tmax, tr, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # returns {channel:[(tv,data),...]}, same as CDSnapshot.getUpdatesInRange()
+        await self.fetchInfo()
+        if self.Tv_end != None:
+            if tmax.tzinfo == None and self.Tv_end.tzinfo != None:
+                tmax = tmax.replace(tzinfo = self.Tv_end.tzinfo)
+            if self.Tv_end < tmax:
+                tmax = self.Tv_end
+        data_columns = self.Table.dataColumns(columns)
+        filter_where, filter_args = self.Table.filterSQL(tr=tr, channel_range=channel_range,
+                                    conditions=conditions, channels=channels)
+        sql = "select distinct on (__channel, __tv) " + ','.join(["__channel, __tv"] + data_columns) + """
+                                from %t_update
+                                where __snapshot_id = %s
+                                    and __tv <= %s """ + filter_where + \
+                                    " order by __channel, __tv, __tr desc"
+        out = {}
+        async for tup in self.Table.iterate(sql, [self.Id, tmax] + filter_args):
+            channel, tv = tup[:2]
+            lst = out.get(channel)
+            if tmin.tzinfo == None and tv.tzinfo != None:
+                tmin = tmin.replace(tzinfo = tv.tzinfo)
+            if not lst or tv <= tmin:
+                lst = out[channel] = []
+            lst.append((tv, tuple(tup[2:])))
+        return out
+
+    async def checkOverlap(self, tmin, data):
+        # returns (overlap, shadow), see CDSnapshot.checkOverlap()
+        tmax = await self.latestUpdate()
+        if tmax == None or tmax < tmin: return False, False
+        first_tv = {}           # {channel: min tv}
+        for channel, tv, values in data:
+            if channel not in first_tv or tv < first_tv[channel]:
+                first_tv[channel] = tv
+        channels = list(first_tv.keys())
+        rows = await self.Table.execute("""select exists (
+                    select 1 from %t_update u, unnest(%s::int[], %s::timestamptz[]) as d(channel, tv)
+                        where u.__snapshot_id = %s and u.__channel = d.channel and u.__tv >= d.tv
+                    )""", (channels, [first_tv[c] for c in channels], self.Id))
+        return True, rows[0][0]
+
+    async def purgeUpdates(self, updates, tolerances):
+        # updates: [(channel, tv, (data, ...)),...], sorted by channel and then by tv
+        # current values of the channels in the batch only
+        updates = list(updates)
+        if not updates:     return updates
+        channels = sorted(set(u[0] for u in updates))
+        values = dict([(tup[0], (tup[1], tup[2:]))
+                        async for tup in self.getValuesIter(await self.latestUpdate(), channels=channels)])
+        return purge_updates(updates, values, tolerances)
+
+    async def addUpdates(self, updates, tolerances):
+        # updates: [(channel, tv, (data, ...)),...], sorted by channel and then by tv
+        await self.fetchInfo()
+        updates = await self.purgeUpdates(updates, tolerances)
+        await self.Table.copy_from(((self.Id, channel, tv) + tuple(data) for channel, tv, data in updates),
+            "%t_update", ['__snapshot_id', '__channel', '__tv'] + self.Table.columns())
+
+    async def addData(self, data):
+        # data: [(channel, (data, ...)),...]
+        await self.fetchInfo()
+        await self.addUpdates([(channel, self.Tv, values) for channel, values in data], [])
+
+class AsyncCDTable:
+
+    MAXUPDATES = CDTable.MAXUPDATES
+
+    def __init__(self, db, name, columns):
+        self.DB = db
+        self.Name = name
+        self.Columns = columns
+        self.Sync = CDTable(None, name, columns)    # SQL building and snapshot list algorithms
+
+    def columns(self):
+        return self.Columns
+
+    def dataColumns(self, columns=None):
+        return self.Sync.dataColumns(columns)
+
+    def filterSQL(self, *params, **args):
+        return self.Sync.filterSQL(*params, **args)
+
+    async def execute(self, sql, args=()):
+        return await self.DB.execute(self.Name, sql, args)
+
+    def iterate(self, sql, args=(), conn=None):
+        return self.DB.iterate(self.Name, sql, args, conn)
+
+    async def copy_from(self, rows, table, columns):
+        return await self.DB.copy_from(self.Name, rows, table, columns)
+
+    async def tags(self):
+        rows = await self.execute("""select __name from %t_tag order by __name""")
+        return [x[0] for x in rows]
+
+    async def findSnapshot(self, t, tag=None, tr=None, data_type=None):
+        type_where, type_args = " and __type is null ", []
+        if data_type != None:
+            type_where, type_args = " and __type = %s ", [data_type]
+        if tag != None:
+            rows = await self.execute("select " + CDSnapshot.infoColumns("s") + """
+                            from %t_snapshot s, %t_tag_snapshot t
+                            where not __deleted
+                                and (s.__tv_end is null or s.__tv_end > %s)
+                                and s.__tv <= %s
+                                and s.__id = t.__snapshot_id
+                                and t.__tag_name = %s """ + type_where +
+                            "order by s.__tr desc limit 1", [t, t, tag] + type_args)
+        elif tr != None:
+            rows = await self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
+                            where not __deleted
+                                and (__tv_end is null or __tv_end > %s)
+                                and __tv <= %s
+                                and __tr <= %s """ + type_where +
+                            "order by __tr desc limit 1", [t, t, tr] + type_args)
+        else:
+            rows = await self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
+                            where not __deleted
+                                and (__tv_end is null or __tv_end > %s)
+                                and __tv <= %s """ + type_where +
+                            "order by __tr desc limit 1", [t, t] + type_args)
+        if not rows:    return None
+        return AsyncCDSnapshot.fromInfo(self, rows[0])
+
+    async def snapshotsInInterval(self, t1, t2, tag=None, tr=None, data_type=None):
+        # returns [snapshot, ...]: the snapshot found for t1 first, then snapshots
+        # beginning between t1 and t2, ordered by tr
+        type_where, type_args = " and __type is null ", []
+        if data_type != None:
+            type_where, type_args = " and __type = %s ", [data_type]
+        if tag != None:
+            query = self.execute("select " + CDSnapshot.infoColumns("s") + """
+                            from %t_snapshot s, %t_tag_snapshot t
+                            where not __deleted
+                                and s.__tv >= %s
+                                and s.__tv < %s
+                                and (s.__tv_end is null or s.__tv_end > %s)
+                                and s.__id = t.__snapshot_id
+                                and t.__tag_name = %s """ + type_where +
+                            "order by s.__tr", [t1, t2, t1, tag] + type_args)
+        elif tr != None:
+            query = self.execute("select " + CDSnapshot.infoColumns() + """
+                            from %t_snapshot
+                            where not __deleted
+                                and __tv >= %s
+                                and __tv < %s
+                                and (__tv_end is null or __tv_end > %s)
+                                and __tr < %s """ + type_where +
+                            "order by __tr", [t1, t2, t1, tr] + type_args)
+        else:
+            query = self.execute("select " + CDSnapshot.infoColumns() + """
+                            from %t_snapshot
+                            where not __deleted
+                                and __tv >= %s
+                                and __tv < %s
+                                and (__tv_end is null or __tv_end > %s) """ + type_where +
+                            "order by __tr", [t1, t2, t1] + type_args)
+        s0, rows = await asyncio.gather(self.findSnapshot(t1, tag=tag, tr=tr, data_type=data_type), query)
+        lst = [AsyncCDSnapshot.fromInfo(self, tup) for tup in rows]
+        if s0:
+            lst = [s0] + [s for s in lst if s.Id != s0.Id]
+        return lst
+
+    async def findSnapshots(self, t1, t2, tag=None, tr=None, data_type=None):
+        lst = await self.snapshotsInInterval(t1, t2, tag=tag, tr=tr, data_type=data_type)
+        return self.Sync.purgeShadowedSnapshots(lst)
+
+    async def findSegments(self, t1, t2, tag=None, tr=None, data_type=None):
+        lst = await self.snapshotsInInterval(t1, t2, tag=tag, tr=tr, data_type=data_type)
+        return self.Sync.overlaySnapshots(lst)
+
+    async def getDataIter(self, t, tag=None, tr=None, data_type=None, channel_range=None, conditions=[],
+                    channels=None, columns=None):
+        # returns async iterator [(channel, tv, data, ...)], same tuples as CDTable.getDataIter():
+        # common data first, then data for data_type. Both snapshots are looked up concurrently
+        types = [None] if data_type is None else [None, data_type]
+        snapshots = await asyncio.gather(*[self.findSnapshot(t, tag=tag, tr=tr, data_type=dt) for dt in types])
+        for s in snapshots:
+            if s != None:
+                async for tup in s.getValuesIter(t, tr=tr, channel_range=channel_range, conditions=conditions,
+                                    channels=channels, columns=columns):
+                    yield tup
+
+    async def getDataIntervalIter(self, t1, t2, tag=None, tr=None, data_type=None, channel_range=None,
+                    conditions = [], channels = None, columns = None):
+        # returns async iterator [(channel, tv, (data,...)),...], same as CDTable.getDataIntervalIter()
+        types = [data_type] if data_type is None else [data_type, None]
+        segments = []
+        for lst in await asyncio.gather(*[self.findSegments(t1, t2, tag=tag, tr=tr, data_type=dt) for dt in types]):
+            segments += lst
+        segments.sort(key=lambda x: x.Tv)
+
+        async for tup in self.getDataIter(t1, tag=tag, tr=tr, data_type=data_type, channel_range=channel_range,
+                                channels=channels, columns=columns):
+            yield (tup[0], tup[1], tup[2:])
+
+        for sg in segments:
+            s = sg.Snapshot
+            ta = max(sg.Tv, t1)
+            tb = sg.Tend
+            if tb == None:  tb = t2
+            elif t2 != None and t2 < tb:    tb = t2
+
+            if s.Tv > t1 and s.Tv >= ta and s.Tv < tb:
+                async for tup in s.getData(channel_range = channel_range, channels = channels, columns = columns):
+                    yield (tup[0], tup[1], tup[2:])
+
+            updates = await s.getUpdatesInRange(ta, tb, tr, channel_range = channel_range, channels = channels,
+                                columns = columns)
+            for channel, ulst in updates.items():
+                for tv, data in ulst:
+                    if tv > t1 and tv >= ta and tv <= tb:
+                        yield (channel, tv, data)
+
+    async def getDataInterval(self, t1, t2, **args):
+        # returns [(channel, tv, (data,...))] sorted by channel, tv
+        return sorted([tup async for tup in self.getDataIntervalIter(t1, t2, **args)])
+
+    async def createSnapshot(self, t, prefill, data_type=None, tv_end=None):
+        s = await AsyncCDSnapshot.create(self, t, data_type, tv_end=tv_end)
+        await s.addData(prefill)
+        return s
+
+    async def addData(self, data, tolerances = None, data_type=""):
+        # data: [(channel, tv, (data, ...)),...]
+        # tolerances: (tolerance,...)
+        # same as CDTable.addData()
+        if not data:    return None
+
+        data.sort() # sort by channel then by tv
+
+        data_time_dict = {}  # {channel: tmin}
+        for channel, tv, values in data:
+            t = data_time_dict.get(channel)
+            if t == None or t > tv:
+                data_time_dict[channel] = tv
+        tmin = min(data_time_dict.values())
+
+        s0 = await self.findSnapshot(tmin, data_type=data_type)
+        new_snapshot = (not s0) or (not not await s0.tags())
+
+        if not new_snapshot:
+            overlap, shadow = await s0.checkOverlap(tmin, data)
+            new_snapshot = shadow or await s0.getUpdateCount() > self.MAXUPDATES
+
+        if new_snapshot:
+            base_list = []
+            async for tup in self.getDataIter(tmin, data_type=data_type):
+                channel, values = tup[0], tup[2:]
+                if channel not in data_time_dict or data_time_dict[channel] != tmin:
+                    base_list.append((channel, values))
+            s1 = await AsyncCDSnapshot.create(self, tmin, data_type)
+            await s1.addData(base_list)
+        else:
+            s1 = s0
+
+        await s1.addUpdates(data, tolerances)
+        return s1
+
+    async def tag(self, tag, comment="", override=False):
+        statements = []
+        if override:
+            statements += [
+                ("delete from %t_tag_snapshot where __tag_name = %s", (tag,)),
+                ("delete from %t_tag where __name = %s", (tag,))
+            ]
+        statements += [
+            ("insert into %t_tag(__name, __comment) values(%s, %s)", (tag, comment)),
+            ("""insert into %t_tag_snapshot(__tag_name, __snapshot_id)
+                    (select %s, __id from %t_snapshot where not __deleted)""", (tag,))
+        ]
+        await self.DB.executeBatch(self.Name, statements)
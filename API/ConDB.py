@@ -1,15 +1,156 @@
 import psycopg2, sys, time, datetime
-import io
+import io, threading, heapq, itertools, re, weakref, base64, contextlib, collections
+from bisect import bisect_left, bisect_right
 from timelib import epoch
 
 from trace import Tracer
 from dbdig import DbDig
-
-def cursor_iterator(c):
-    tup = c.fetchone()
-    while tup:
-        yield tup
-        tup = c.fetchone()
+from pgcopy import PGCopyWriter, CopyStream, text_copy_chunks, session_timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def cursor_iterator(c, batch_size = None):
+    # fetches rows in batches, by default of the cursor's itersize
+    batch_size = batch_size or c.itersize
+    tups = c.fetchmany(batch_size)
+    while tups:
+        for tup in tups:
+            yield tup
+        tups = c.fetchmany(batch_size)
+
+def merge_by_channel(data, updates):
+    # data, updates: iterators [(channel, tv, data, ...),...], ordered by channel, one tuple per channel
+    # returns iterator [(channel, tv, data, ...),...] ordered by channel,
+    # where updates override data for the same channel
+    data = iter(data)
+    updates = iter(updates)
+    d = next(data, None)
+    u = next(updates, None)
+    while d is not None or u is not None:
+        if u is None or (d is not None and d[0] < u[0]):
+            yield d
+            d = next(data, None)
+        else:
+            if d is not None and d[0] == u[0]:
+                d = next(data, None)
+            yield u
+            u = next(updates, None)
+
+def positional_parameters(sql):
+    # converts psycopg2 style %s parameters into $1, $2... for PREPARE
+    # returns (sql, number of parameters)
+    counter = itertools.count(1)
+    def replace(m):
+        if m.group(0) == "%%":  return "%"
+        return "$%d" % (next(counter),)
+    sql = re.sub("%%|%s", replace, sql)
+    return sql, next(counter) - 1
+
+def tuples_to_arrays(tuples, dtypes, batch_size = 10000):
+    # tuples: iterator [(x, y, ...),...]
+    # returns [array,...], one NumPy array per tuple position, filled batch by batch
+    # so that only one batch of tuples is in memory at a time.
+    # A column which does not fit its dtype (e.g. nulls in an integer column) becomes an object array
+    chunks = [[] for dt in dtypes]
+    tuples = iter(tuples)
+    batch = list(itertools.islice(tuples, batch_size))
+    while batch:
+        for lst, dt, column in zip(chunks, dtypes, zip(*batch)):
+            try:    a = numpy.array(column, dtype=dt)
+            except (TypeError, ValueError):
+                a = numpy.array(column, dtype=object)
+            lst.append(a)
+        batch = list(itertools.islice(tuples, batch_size))
+    return [numpy.concatenate(lst) if lst else numpy.empty(0, dtype=dt) for lst, dt in zip(chunks, dtypes)]
+
+def purge_updates(updates, values, tolerances):
+    #
+    # IMPORTANT: updates must be sorted by channel and then by tv
+    #
+    # updates: [(channel, tv, (data, ...)),...]
+    # values: {channel: (tv, (data,...))}, current values
+    # tolerances: (tolerance,...)
+    # returns the updates which differ from the previous value of the channel by more than the tolerance
+    new_updates = []
+    #print 'purgeUpdates: %d updates' % (len(updates),)
+
+    last_chan = None
+    last_values = None
+    last_tv = None
+    
+    #print("purgeUpdates: updates:")
+    #for upd in updates:
+    #    print("   ", upd)
+    
+    for upd in updates:
+        chn, tv, data = upd
+        if chn != last_chan:
+            last_chan = chn
+            last_tv, last_values = values.get(chn, (None, None))
+
+        close = False
+        if last_values:
+            close = True
+            if tolerances:
+                for j, x in enumerate(last_values):
+                    new = data[j]
+                    if x != new:
+                        close = False
+                        if type(x) in (type(1), type(1.0)):
+                            t = tolerances[j]
+                            #print 'tolerance[%d] = %s (%s)' % (
+                            #        j, t, type(t))
+                            if t and t > 0:
+                                close = abs(x-new) <= t
+                    if not close:   break
+            else:
+                close = last_values == data
+        if not close:
+            last_values = data
+            last_tv = tv
+            new_updates.append(upd)
+    return new_updates
+
+def aware_times(times, db):
+    # returns the times with naive ones in the session time zone of the DB connection, as the DB
+    # interprets them, so they can be compared to the timezone-aware times read from the DB
+    if all(t.tzinfo is not None for t in times):
+        return times
+    tz = session_timezone(db.connect()) or datetime.timezone.utc
+    return [t if t.tzinfo is not None else t.replace(tzinfo=tz) for t in times]
+
+def on_primary(method):
+    # decorator for CDTable and CDSnapshot write methods: all statements they execute,
+    # reads included, go to the primary database
+    def decorated(self, *params, **args):
+        db = self.Table.DB if isinstance(self, CDSnapshot) else self.DB
+        outer = not db.onPrimary()
+        with db.primary():
+            if outer:
+                db.beginWrite()
+            return method(self, *params, **args)
+    decorated.__name__ = method.__name__
+    return decorated
+
+def channel_selected(channel, channel_range=None, channels=None):
+    # Python side equivalent of the channel filters built by CDTable.filterSQL()
+    if channel_range:
+        cmin, cmax = channel_range
+        if (cmin is not None and channel < cmin) or (cmax is not None and channel > cmax):
+            return False
+    if channels:
+        for c in channels:
+            if isinstance(c, (tuple, list)):
+                c0, c1 = c
+                if (c0 is None or channel >= c0) and (c1 is None or channel <= c1):
+                    return True
+            elif channel == c:
+                return True
+        return False
+    return True
 
 class dict_with_default:
     def __init__(self, default = None):
@@ -30,25 +171,305 @@ class dict_with_default:
     def __getattr__(self, x):
         return getattr(self.Dict, x)
 
-def format_conditions(conditions):
-    lst = []
-    for c, op, v in conditions:
-        lst.append("(%s %s '%s')" % (c, op, v))
-    return " and ".join(lst)
+class CDConnectionPool:
+    #
+    # Thread-safe pool of psycopg2 connections.
+    # Each thread checks out at most one connection with connect() and keeps it until
+    # it returns it with release(). Connections held by threads which ended without
+    # releasing them are reclaimed when the pool runs out of connections.
+    # Idle connections are checked with a round trip before reuse if they were idle for
+    # longer than check_interval seconds, and closed after idle_timeout seconds,
+    # keeping at least min_size connections open.
+    # timeout: default for connect(), seconds to wait for a free connection, None - wait forever
+    #
+
+    ReclaimInterval = 1.0       # seconds between checks for connections of ended threads while waiting
+
+    def __init__(self, connstr, min_size=1, max_size=10, check_interval=30, idle_timeout=300, timeout=None):
+        assert 0 <= min_size <= max_size and max_size > 0
+        self.ConnStr = connstr
+        self.Timeout = timeout
+        self.MinSize = min_size
+        self.MaxSize = max_size
+        self.CheckInterval = check_interval
+        self.IdleTimeout = idle_timeout
+        self.Lock = threading.Condition()
+        self.Idle = []          # [(connection, idle since)], most recently returned last
+        self.InUse = {}         # {thread: connection or None while being opened}
+        self.Closed = False
+        for _ in range(min_size):
+            self.Idle.append((self.newConnection(), time.time()))
+
+    def newConnection(self):
+        return psycopg2.connect(self.ConnStr)
+
+    def size(self):
+        with self.Lock:
+            return len(self.Idle) + len(self.InUse)
+
+    @staticmethod
+    def closeConnection(conn):
+        try:    conn.close()
+        except psycopg2.Error:
+            pass
+
+    def healthy(self, conn, idle_since):
+        if conn.closed:     return False
+        if time.time() - idle_since < self.CheckInterval:
+            return True
+        try:
+            conn.rollback()
+            c = conn.cursor()
+            c.execute("select 1")
+            c.fetchone()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def reclaim(self):
+        # called with the lock held
+        for thread, conn in list(self.InUse.items()):
+            if not thread.is_alive():
+                del self.InUse[thread]
+                if conn is not None:
+                    self.Idle.insert(0, (conn, 0))      # force health check, which also ends the transaction
+
+    def prune(self):
+        # called with the lock held
+        now = time.time()
+        while self.Idle and len(self.Idle) + len(self.InUse) > self.MinSize \
+                    and now - self.Idle[0][1] > self.IdleTimeout:
+            conn, _ = self.Idle.pop(0)
+            self.closeConnection(conn)
+
+    def connect(self, timeout=None):
+        # returns the connection checked out by the current thread, checks one out if needed
+        thread = threading.current_thread()
+        if timeout is None:
+            timeout = self.Timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.Lock:
+                conn = self.InUse.get(thread)
+                if conn is not None:
+                    if not conn.closed:     return conn
+                    del self.InUse[thread]
+                while True:
+                    if self.Closed:
+                        raise RuntimeError("Connection pool is closed")
+                    if self.Idle:
+                        conn, idle_since = self.Idle.pop()
+                        break
+                    self.reclaim()
+                    if self.Idle:   continue
+                    if len(self.InUse) < self.MaxSize:
+                        conn, idle_since = None, None
+                        break
+                    wait = self.ReclaimInterval     # threads which end do not notify, poll for them
+                    if deadline is not None:
+                        if deadline <= time.time():
+                            raise RuntimeError("Timeout waiting for a connection from the pool")
+                        wait = min(wait, deadline - time.time())
+                    self.Lock.wait(wait)
+                self.InUse[thread] = None       # reserve the slot
+            try:
+                if conn is not None and not self.healthy(conn, idle_since):
+                    self.closeConnection(conn)
+                    conn = None
+                if conn is None:
+                    conn = self.newConnection()
+            except:
+                with self.Lock:
+                    del self.InUse[thread]
+                    self.Lock.notify()
+                raise
+            with self.Lock:
+                self.InUse[thread] = conn
+            return conn
+
+    def release(self):
+        # returns the connection checked out by the current thread to the pool.
+        # The transaction left open by reads is rolled back, writes are committed by ConDB
+        thread = threading.current_thread()
+        with self.Lock:
+            conn = self.InUse.pop(thread, None)
+        if conn is not None and not conn.closed:
+            try:    conn.rollback()
+            except psycopg2.Error:
+                self.closeConnection(conn)
+        with self.Lock:
+            if conn is not None and not conn.closed:
+                if self.Closed:
+                    self.closeConnection(conn)
+                else:
+                    self.Idle.append((conn, time.time()))
+            self.prune()
+            self.Lock.notify()
+
+    def close(self):
+        with self.Lock:
+            self.Closed = True
+            for conn, _ in self.Idle:
+                self.closeConnection(conn)
+            self.Idle = []
+            self.Lock.notify_all()
+
+class CDReplica:
+    #
+    # Read replica of the primary database.
+    # Keeps the moving average of the statement execution time for latency based routing.
+    # To share the replica between threads, e.g. in the server, create it with a CDConnectionPool
+    #
+
+    Alpha = 0.2         # weight of the last measurement in the latency average
+
+    def __init__(self, replica):
+        # replica: connstr or CDConnectionPool
+        self.Pool = replica if isinstance(replica, CDConnectionPool) else None
+        self.ConnStr = replica.ConnStr if self.Pool is not None else replica
+        self.Conn = None
+        self.Latency = None     # seconds
+        self.Lock = threading.Lock()
+
+    def __str__(self):
+        return "<CDReplica %s latency=%s>" % (self.ConnStr, self.Latency)
+
+    __repr__ = __str__
+
+    def connect(self):
+        if self.Pool is not None:
+            return self.Pool.connect()
+        if self.Conn is None:
+            self.Conn = psycopg2.connect(self.ConnStr)
+        return self.Conn
+
+    def disconnect(self):
+        if self.Pool is not None:
+            self.Pool.release()
+        elif self.Conn is not None:
+            self.Conn.close()
+            self.Conn = None
+
+    def record(self, dt):
+        with self.Lock:
+            if self.Latency is None:    self.Latency = dt
+            else:   self.Latency += (dt - self.Latency)*self.Alpha
 
 class ConDB:
-    def __init__(self, connstr=None, connection=None):
+
+    CursorNumbers = itertools.count(1)      # to generate unique server side cursor names
+
+    IterSize = 10000        # default number of rows fetched at once from server side cursors
+
+    # Prepared statements live in the DB session, so they are registered per connection
+    # and survive the ConDB objects sharing the connection, e.g. with a connection pool
+    PreparedStatements = weakref.WeakKeyDictionary()    # {connection: OrderedDict {(table, kind, sql): statement name}}
+    PreparedStatementsLock = threading.Lock()
+    MaxPreparedStatements = 100     # per connection, least recently used ones are deallocated
+    StatementNumbers = itertools.count(1)
+    
+    T = Tracer()            # prepared_hit, prepared_miss counters
+
+    ReadStatement = re.compile(r"\s*select\b", re.I)
+    ReplicaNumbers = itertools.count()      # round robin over replicas, shared by ConDB objects
+
+    def __init__(self, connstr=None, connection=None, snapshot_catalog=False, itersize=None,
+                    prepare=False, pool=None, replicas=[], routing="round_robin", read_your_writes=None):
+        # pool: CDConnectionPool. If given, each thread using this ConDB object works with
+        # its own connection checked out from the pool, returned with disconnect()
+        #
+        # replicas: [connstr, CDConnectionPool or CDReplica,...], read replicas of the primary.
+        #   Select statements go to a replica, everything else and all statements executed by
+        #   the write methods (addData, patch, tag, createSnapshot,...) go to the primary.
+        #   Each thread sticks to the replica chosen for its first read until disconnect(),
+        #   so the snapshot lookups and data reads of one request see the same replica.
+        # routing: "round_robin" or "latency" - the replica with the lowest average statement time
+        # read_your_writes: seconds after a write during which reads go to the primary, or None
+        # prepare: True - point lookups use prepared statements, bulk reads keep streaming
+        #   from server side cursors; "all" - bulk reads use prepared statements too and
+        #   are fetched at once
         self.Conn = connection
         self.ConnStr = connstr
-        
+        self.Pool = pool
+        if pool is not None and connstr is None:
+            self.ConnStr = pool.ConnStr
+        self.UseSnapshotCatalog = snapshot_catalog
+        self.IterSize = itersize or self.IterSize
+        self.Prepare = prepare
+        assert routing in ("round_robin", "latency")
+        self.Replicas = [r if isinstance(r, CDReplica) else CDReplica(r) for r in replicas]
+        self.Routing = routing
+        self.ReadYourWrites = read_your_writes
+        self.LastWrite = None
+        self.Local = threading.local()      # PrimaryDepth, Replica
+        
+    @contextlib.contextmanager
+    def primary(self):
+        # all statements executed in the block by the current thread, reads included, go to the primary.
+        # LastWrite is set by the writes themselves, in execute() and copy_from()
+        self.Local.PrimaryDepth = getattr(self.Local, "PrimaryDepth", 0) + 1
+        try:
+            yield self
+        finally:
+            self.Local.PrimaryDepth -= 1
+
+    def beginWrite(self):
+        # __tr of the rows written defaults to the transaction start time, and changesSince waits only
+        # for the transactions which have a transaction id. A transaction left open by earlier reads
+        # is ended, the new one takes a transaction id before the write method reads anything
+        conn = self.connect()
+        c = conn.cursor()
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            c.execute("select txid_current_if_assigned()")
+            if c.fetchone()[0] is not None:
+                return          # writes in progress, keep them
+            conn.rollback()
+        c.execute("select txid_current()")
+
+    def onPrimary(self):
+        # True inside primary() blocks, e.g. in the methods decorated with on_primary
+        return getattr(self.Local, "PrimaryDepth", 0) > 0
+
+    def readReplica(self):
+        # returns the replica to use for a read by the current thread, or None for the primary
+        if not self.Replicas or self.onPrimary():
+            return None
+        if self.ReadYourWrites is not None and self.LastWrite is not None \
+                    and time.time() < self.LastWrite + self.ReadYourWrites:
+            return None
+        replica = getattr(self.Local, "Replica", None)
+        if replica is None:
+            if self.Routing == "latency":
+                # replicas not measured yet first
+                replica = min(self.Replicas, key=lambda r: -1.0 if r.Latency is None else r.Latency)
+            else:
+                replica = self.Replicas[next(self.ReplicaNumbers) % len(self.Replicas)]
+            self.Local.Replica = replica
+        return replica
+
     def connect(self):
+        if self.Pool is not None:
+            return self.Pool.connect()
         if self.Conn == None:
             self.Conn = psycopg2.connect(self.ConnStr)
         return self.Conn
     
-    def cursor(self):
-        conn = self.connect()
-        return conn.cursor()
+    def cursor(self, server_side=False, conn=None):
+        # server side (named) cursors keep the result set in the DB and send it to the client
+        # in batches. They can only be used inside a transaction
+        conn = conn or self.connect()
+        if server_side and not conn.autocommit:
+            if conn.status == psycopg2.extensions.STATUS_IN_TRANSACTION and \
+                    conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # the transaction was ended with "commit" executed as SQL, psycopg2 does not know it
+                # and would not begin a new one for the cursor
+                conn.rollback()
+            c = conn.cursor("condb_cursor_%d" % (next(self.CursorNumbers),))
+        else:
+            c = conn.cursor()
+        c.itersize = self.IterSize
+        return c
         
     def table(self, name, columns):
         return CDTable(self, name, columns)
@@ -62,7 +483,7 @@ class ConDB:
         return t
         
     def namespaces(self):
-        dig = DbDig(self.Conn)
+        dig = DbDig(self.connect())
         return dig.nspaces()
 
     def createTable(self, name, column_types, owner=None,
@@ -71,36 +492,117 @@ class ConDB:
                     grants, drop_existing)
         return t
 
-    def execute(self, table, sql, args=()):
+    def execute(self, table, sql, args=(), server_side=False, prepared=None, read=None):
+        # prepared: query kind. If given and prepared statements are enabled, the statement
+        # is prepared once per connection and then executed by name. Prepared statements
+        # can not be used with server side cursors, so server side queries are prepared
+        # only with prepare="all", and then server_side is ignored
+        # read: True for read only statements, which may go to a replica, False for writes.
+        #   If None, select statements are reads, anything else is a write
         #print "DB.execute(%s, %s, %s)" % (table, sql, args)
         table_no_ns = table.split('.')[-1]
         sql = sql.replace('%t', table)
         sql = sql.replace('%T', table_no_ns)
-        c = self.cursor()
-        #print "executing: <%s>, %s" % (sql, args)
+        replica = None
+        if read is None:
+            read = self.ReadStatement.match(sql) is not None
+        if read:
+            replica = self.readReplica()
+        else:
+            self.LastWrite = time.time()
+        conn = self.connect() if replica is None else replica.connect()
         t0 = time.time()
-        #print("ConDB.execute: sql:", sql, "\n      args:", args)
-        c.execute(sql, args)
+        if prepared and self.Prepare and (not server_side or self.Prepare == "all"):
+            c = self.executePrepared(table, prepared, sql, args, conn)
+        else:
+            c = self.cursor(server_side, conn)
+            #print "executing: <%s>, %s" % (sql, args)
+            #print("ConDB.execute: sql:", sql, "\n      args:", args)
+            c.execute(sql, args)
         #print "executed. t=%s" % (time.time() - t0,)
+        if replica is not None:
+            replica.record(time.time() - t0)
+        return c
+
+    def preparedStatements(self, conn):
+        with self.PreparedStatementsLock:
+            statements = self.PreparedStatements.get(conn)
+            if statements is None:
+                statements = self.PreparedStatements[conn] = collections.OrderedDict()
+            return statements
+
+    def executePrepared(self, table, kind, sql, args, conn=None):
+        conn = conn or self.connect()
+        statements = self.preparedStatements(conn)
+        key = (table, kind, sql)
+        c = self.cursor(conn=conn)
+        for attempt in (1, 2):
+            # a transaction in progress may have server side cursors open, they must survive
+            # the retry, so the statement is retried only if the failed one began the transaction
+            idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            with self.PreparedStatementsLock:
+                name = statements.get(key)
+                if name is not None:
+                    statements.move_to_end(key)
+            if name is None:
+                self.T.count("prepared_miss")
+                name = "condb_stmt_%d" % (next(self.StatementNumbers),)
+                prepared_sql, nparams = positional_parameters(sql)
+                assert nparams == len(args)
+                c.execute("prepare %s as %s" % (name, prepared_sql))
+                with self.PreparedStatementsLock:
+                    statements[key] = name
+                    evicted = []
+                    while len(statements) > self.MaxPreparedStatements:
+                        evicted.append(statements.popitem(last=False)[1])
+                for old_name in evicted:
+                    c.execute("deallocate " + old_name)
+            else:
+                self.T.count("prepared_hit")
+            params = "(" + ",".join(["%s"]*len(args)) + ")" if args else ""
+            try:
+                c.execute("execute " + name + params, args)
+                break
+            except psycopg2.Error as e:
+                if e.pgcode == "26000":
+                    # invalid statement name: the session was reset (e.g. DISCARD ALL), prepare again
+                    with self.PreparedStatementsLock:
+                        statements.clear()
+                    if attempt == 1 and idle:
+                        conn.rollback()
+                        continue
+                raise
         return c
 
-    def copy_from(self, table, data, table_template, columns):
+    CopyBufferSize = 65536
+
+    def copy_from(self, table, data, table_template, columns, binary=False):
         # table: <table> or <schema>.<table>
+        # data: file-like object with text or, if binary=True, binary COPY data
+        self.LastWrite = time.time()
         c = self.cursor()
         table = table_template.replace('%t', table)
         assert "'" not in table
         assert sum(x == '.' for x in table) < 2
         columns = ','.join(columns)
         assert "'" not in columns
-        c.copy_expert(f"copy {table} ({columns}) from stdin", data)
+        options = " with (format binary)" if binary else ""
+        c.copy_expert(f"copy {table} ({columns}) from stdin{options}", data, size=self.CopyBufferSize)
         return c
         
     def disconnect(self):
+        replica = getattr(self.Local, "Replica", None)
+        if replica is not None:
+            replica.disconnect()
+            self.Local.Replica = None
+        if self.Pool is not None:
+            self.Pool.release()
+            return
         if self.Conn:   self.Conn.close()
         self.Conn = None
 
     def tables(self, namespace = "public"):
-        dig = DbDig(self.Conn)
+        dig = DbDig(self.connect())
         db_tables = dig.tables(namespace) or []
         db_tables_set = set(db_tables)
         db_tables.sort()
@@ -139,6 +641,22 @@ class CDSnapshot:
 
     __repr__ = __str__
 
+    InfoColumns = ["__id", "__tv", "__tv_end", "__tr", "__deleted", "__type"]
+
+    @staticmethod
+    def infoColumns(alias = None):
+        # returns comma separated list of snapshot table columns to be used with fromInfo()
+        prefix = alias + "." if alias else ""
+        return ",".join([prefix + c for c in CDSnapshot.InfoColumns])
+
+    @staticmethod
+    def fromInfo(table, tup):
+        # tup: (id, tv, tv_end, tr, deleted, type) as selected with infoColumns()
+        s = CDSnapshot(table, tup[0])
+        s.Tv, s.Tv_end, s.Tr, s.Deleted, s.DataType = tup[1:6]
+        s.InfoFetched = True
+        return s
+
     @staticmethod
     def create(table, tv, data_type, tv_end = None):
         c = table.execute("""insert into %t_snapshot(__tv, __type, __tv_end)
@@ -146,8 +664,10 @@ class CDSnapshot:
                 select lastval();""", (tv, data_type, tv_end))
         sid = c.fetchone()[0]
         c.execute("commit")
+        CDSnapshotCatalog.invalidate(table)
         s = CDSnapshot(table, sid)
-        s.fetchInfo()
+        with table.DB.primary():
+            s.fetchInfo()
         return s
         
     def fetchInfo(self):
@@ -157,13 +677,13 @@ class CDSnapshot:
             c = self.Table.execute("""select __tv, __tv_end, __tr, 
                             __deleted, __type
                     from %t_snapshot
-                    where __id=%s""", (self.Id,))
+                    where __id=%s""", (self.Id,), prepared="snapshot_info")
             #print "Fetched"
             self.Tv, self.Tv_end, self.Tr, self.Deleted, self.DataType = c.fetchone()    
             self.InfoFetched = True
         return self
 
-    def getData(self, channel_range = None, conditions = []):  
+    def getData(self, channel_range = None, conditions = [], channels = None, columns = None):  
         # returns [(channel, tv, data, ...)]
         #print 'CDSnapshot.getData(): self.Data=%s' % (self.Data,)
         
@@ -178,28 +698,29 @@ class CDSnapshot:
         
         self.T['getData/fetch'].begin()
         self.fetchInfo()
-        data_columns = self.Table.columns()
+        data_columns = self.Table.dataColumns(columns)
         columns = ','.join(["__channel"] + data_columns)
-        channels = ""
-        if channel_range:
-            channels = " and __channel between %s and %s " % channel_range
-        cond_where = format_conditions(conditions)
-        if cond_where:  cond_where = " and " + cond_where
-        #print cond_where
+        filter_where, filter_args = self.Table.filterSQL(channel_range=channel_range, conditions=conditions,
+                                    channels=channels)
         sql = "select " + columns + """ from %t_snapshot_data
-                                where __snapshot_id = %s""" + channels + cond_where
+                                where __snapshot_id = %s""" + filter_where + \
+                                " order by __channel"
         #print "snapshot.getData: sql = %s" % (sql,)
-        try:    c = self.Table.execute(sql, (self.Id,))
-        except:
-            self.Table.execute("rollback")
+        try:    c = self.Table.execute(sql, [self.Id] + filter_args, server_side=True, 
+                                    prepared="snapshot_data")
+        except Exception as e:
+            # roll back the connection the query failed on, which may be a replica
+            cursor = getattr(e, "cursor", None)
+            if cursor is not None:
+                cursor.connection.rollback()
+            else:
+                self.Table.execute("rollback")
             return
         #print "snapshot.getData: executed"
         self.T['getData'].end()
         #print "returning from getData with iterator"
-        tup = c.fetchone()
-        while tup:
+        for tup in cursor_iterator(c):
             yield (tup[0], self.Tv) + tup[1:]
-            tup = c.fetchone()
 
     def getDataAsDict(self, channel_range = None, conditions = []):
         # returns {channel:(tv, data)}
@@ -230,7 +751,7 @@ class CDSnapshot:
             sql = "select distinct on (__channel, __tv) " + columns + """ from %t_update
                                     where __snapshot_id = %s
                                     order by __channel, __tv, __tr desc"""
-            c = self.Table.execute(sql, (self.Id,))
+            c = self.Table.execute(sql, (self.Id,), server_side=True)
             out = {}
             #print "getAllUpdates: making dictionary..."
 
@@ -286,6 +807,31 @@ class CDSnapshot:
         return [(ch, tvmin, tvmax) for ch, tvmin, tvmax in cursor_iterator(c)]
         
     def checkOverlap(self, tmin, data):
+        # data: [(channel, tv, (data, ...)),...]
+        # returns (overlap, shadow):
+        #   overlap: min(data tv) <= max(updates tv)
+        #   shadow: for at least one channel, data tv <= updates tv
+        # only the earliest tv of each channel in data is sent to the DB, checked with the
+        # (__channel, __tv) index, so the updates of the snapshot are not loaded
+
+        tmax = self.latestUpdate()
+        if tmax == None or tmax < tmin: return False, False
+
+        first_tv = {}           # {channel: min tv}
+        for channel, tv, values in data:
+            t = first_tv.get(channel)
+            if t is None or tv < t:
+                first_tv[channel] = tv
+        channels = list(first_tv.keys())
+        c = self.Table.execute("""select exists (
+                    select 1 from unnest(%s::int[], %s::timestamptz[]) as d(channel, tv)
+                        where exists (select 1 from %t_update u
+                            where u.__snapshot_id = %s and u.__channel = d.channel and u.__tv >= d.tv)
+                    )""", (channels, [first_tv[ch] for ch in channels], self.Id))
+        shadow = c.fetchone()[0]
+        return True, shadow
+
+    def checkOverlap_(self, tmin, data):
     
         tmax = self.latestUpdate()
         if tmax == None or tmax < tmin: return False, False
@@ -337,7 +883,8 @@ class CDSnapshot:
         self.T['getValues'].end()
         return tup, tv            
 
-    def getUpdatesInRange(self, tmin, tmax, tr, channel_range = None, conditions = []):
+    def getUpdatesInRange(self, tmin, tmax, tr, channel_range = None, conditions = [], channels = None, 
+                    columns = None):
         # returns updates where tv <= tmax
         # returns {channel:[(tv,data),...]}
         
@@ -345,22 +892,15 @@ class CDSnapshot:
             tmax = self.Tv_end
         
         self.fetchInfo()
-        data_columns = self.Table.columns()
+        data_columns = self.Table.dataColumns(columns)
         columns = ','.join(["__channel, __tv, __tr"] + data_columns)
-        tr_where = ""
-        if tr:  tr_where = "and __tr < '%s'" % (tr.strftime("%Y-%m-%d %H:%M:%S"),)
-        channels = ""
-        if channel_range:
-            channels = " and __channel between %s and %s " % channel_range
-        cond_where = ""
-        if conditions:
-            for name, op, value in conditions:
-                cond_where += " and %s %s '%s'" % (name, op, value)
+        filter_where, filter_args = self.Table.filterSQL(tr=tr, channel_range=channel_range, 
+                                    conditions=conditions, channels=channels)
         sql = "select " + columns + """ from %t_update
                                 where __snapshot_id = %s
-                                    and __tv <= %s """ + tr_where + channels + cond_where + \
+                                    and __tv <= %s """ + filter_where + \
                                     " order by __channel, __tv, __tr desc"""
-        c = self.Table.execute(sql, (self.Id, tmax))
+        c = self.Table.execute(sql, [self.Id, tmax] + filter_args, server_side=True)
         dict = {}
         last_channel, last_tv, last_tr = None, None, None
         for tup in cursor_iterator(c):
@@ -381,48 +921,53 @@ class CDSnapshot:
         return dict
         
 
-    def getUpdatesForTime(self, tv, tr = None, channel_range = None, conditions = []):
+    def getUpdatesForTime(self, tv, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
         # returns iterator [(channel,tv,data,...),...]
         #print "getUpdatesForTime: Updates: %s" % (self.Updates,)
         if not self.Updates:
             return self.getUpdatesForTimeFromDB(tv, tr = tr, 
-                                channel_range = channel_range, conditions = conditions)
+                                channel_range = channel_range, conditions = conditions, channels = channels,
+                                columns = columns)
         else:
             return self.getUpdatesForTimeFromCache(tv, tr = tr, 
-                                channel_range = channel_range, conditions = conditions)
-
-    def getUpdatesForTimeFromCache(self, tv, tr = None, channel_range = None, conditions = []):
-        # returns iterator [(channel,tv,data,...),...]
-        for channel, lst in self.Updates.items():
+                                channel_range = channel_range, conditions = conditions, channels = channels,
+                                columns = columns)
+
+    def getUpdatesForTimeFromCache(self, tv, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # returns iterator [(channel,tv,data,...),...] ordered by channel
+        indexes = None
+        if columns is not None:
+            all_columns = self.Table.columns()
+            indexes = [all_columns.index(c) for c in self.Table.dataColumns(columns)]
+        for channel in sorted(self.Updates.keys()):
+            lst = self.Updates[channel]
             last_tv, last_data = None, None
             for t, data in lst:
                 if t <= tv:
                     last_tv = t
                     last_data = data
             if not last_tv is None:
-                if channel_range is None or (
-                        channel_range[0] <= channel and channel <= channel_range[1]):
+                if channel_selected(channel, channel_range, channels):
+                    if indexes is not None:
+                        last_data = tuple(last_data[i] for i in indexes)
                     yield (channel, last_tv) + last_data
 
-    def getUpdatesForTimeFromDB(self, tv, tr = None, channel_range = None, conditions = []):
-        # returns iterator [(channel,tv,data,...),...]
+    def getUpdatesForTimeFromDB(self, tv, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # returns iterator [(channel,tv,data,...),...] ordered by channel
         self.fetchInfo()
-        data_columns = self.Table.columns()
+        data_columns = self.Table.dataColumns(columns)
         columns = ','.join(["__channel, __tv"] + data_columns)
-        tr_where = ""
-        if tr:  tr_where = "and __tr < '%s'" % (tr.strftime("%Y-%m-%d %H:%M:%S"),)
-        channels = ""
-        if channel_range:
-            channels = " and __channel between %s and %s " % channel_range
-        cond_where = ""
-        if conditions:
-            for name, op, value in conditions:
-                cond_where += " and %s %s '%s'" % (name, op, value)
+        filter_where, filter_args = self.Table.filterSQL(tr=tr, channel_range=channel_range, 
+                                    conditions=conditions, channels=channels)
         sql = "select distinct on (__channel) " + columns + """ from %t_update
                                 where __snapshot_id = %s
-                                    and __tv <= %s """ + tr_where + channels + cond_where + \
+                                    and __tv <= %s """ + filter_where + \
                                     " order by __channel, __tr desc, __tv desc"""
-        c = self.Table.execute(sql, (self.Id, tv))
+        c = self.Table.execute(sql, [self.Id, tv] + filter_args, server_side=True, 
+                                    prepared="updates_for_time")
         
         #print "getUpdatesForTimeFromDB: sql: %s\n      got %d rows" % (sql, len(c.fetchall()),)
         
@@ -443,31 +988,52 @@ class CDSnapshot:
             data[channel] = (tv, tup[2:])
         return data
             
-    def getValuesIter(self, t, tr = None, channel_range = None, conditions = []):
-        # returns [(channel, tv, data, ...),...]
+    def getValuesIter(self, t, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # returns [(channel, tv, data, ...),...] ordered by channel
+        # snapshot data and updates are both read ordered by channel and merged as they arrive,
+        # so neither of them is loaded in memory
         #print "s.getValuesIter(t=%s)" % (t,)
-        data = self.getDataAsDict(channel_range=channel_range, conditions=conditions)
-        #print "s.getValuesIter: data: %s" % (data,)
-        
-        updates = self.getUpdatesForTime(t, tr=tr, channel_range=channel_range, conditions=conditions)
-
-        updates = list(updates)
-        #print "s.getValuesIter: updates: %s" % (updates,)     
-        
-        for tup in updates:
-            channel = tup[0]
-            if channel_range is None or (
-                    channel_range[0] <= channel and channel <= channel_range[1]):
-                tv = tup[1]
-                if channel in data:   del data[channel]
-                #print "s.getValuesIter: yielding ", tup
-                yield tup
-        for channel, (tv, values) in data.items():
-            if channel_range is None or (
-                    channel_range[0] <= channel and channel <= channel_range[1]):
-                #print "s.getValuesIter: yielding ", (channel, tv) + values
-                yield (channel, tv) + values
-
+        data = self.getData(channel_range=channel_range, conditions=conditions, channels=channels,
+                                columns=columns)
+        updates = self.getUpdatesForTime(t, tr=tr, channel_range=channel_range, conditions=conditions, 
+                                channels=channels, columns=columns)
+        return merge_by_channel(data, updates)
+
+
+    def getValuesAtTimes(self, times, tr = None, channel_range = None, conditions = [], channels = None,
+                    columns = None):
+        # times: sorted list of times
+        # returns [[(channel, tv, data, ...),...] ordered by channel, for each time in times],
+        # same as getValuesIter() for each time, but snapshot data and updates are read only once.
+        # Updates are read ordered by channel and tv, and for each channel the times are resolved
+        # in one pass over its updates
+        if not times:   return []
+        times = aware_times(times, self.Table.DB)
+        data = list(self.getData(channel_range=channel_range, conditions=conditions, channels=channels,
+                                columns=columns))
+        data_columns = self.Table.dataColumns(columns)
+        columns = ','.join(["__channel, __tv, __tr"] + data_columns)
+        filter_where, filter_args = self.Table.filterSQL(tr=tr, channel_range=channel_range, 
+                                    conditions=conditions, channels=channels)
+        sql = "select " + columns + """ from %t_update
+                                where __snapshot_id = %s
+                                    and __tv <= %s """ + filter_where + \
+                                    " order by __channel, __tv"
+        c = self.Table.execute(sql, [self.Id, times[-1]] + filter_args, server_side=True)
+        updates = [[] for t in times]       # [[(channel, tv, data, ...),...] ordered by channel, for each time]
+        for channel, rows in itertools.groupby(cursor_iterator(c), lambda tup: tup[0]):
+            rows = list(rows)
+            i, n = 0, len(rows)
+            best = None             # the update with latest (tr, tv) among those with tv <= t
+            for lst, t in zip(updates, times):
+                while i < n and rows[i][1] <= t:
+                    if best is None or (rows[i][2], rows[i][1]) >= (best[2], best[1]):
+                        best = rows[i]
+                    i += 1
+                if best is not None:
+                    lst.append((channel, best[1]) + best[3:])
+        return [list(merge_by_channel(data, lst)) for lst in updates]
             
     def invalidateCache(self):
         self.Data = None
@@ -488,51 +1054,22 @@ class CDSnapshot:
         self.T['purgeUpdates'].begin()
         #print('purgeUpdates: tolerances:', tolerances)
 
+        updates = list(updates)
+        if not updates:
+            self.T['purgeUpdates'].end()
+            return updates
+
         latest_update = self.latestUpdate()
         #print("purgeUpdates: latest_update:", latest_update)
         
-        my_data_dict = self.getValues(latest_update)
+        # current values of the channels in the batch only
+        channels = sorted(set(u[0] for u in updates))
+        my_data_dict = dict((tup[0], (tup[1], tup[2:])) 
+                for tup in self.getValuesIter(latest_update, channels=channels))
         
         #print latest_update, my_data_dict
         
-        new_updates = []
-        #print 'purgeUpdates: %d updates' % (len(updates),)
-
-        last_chan = None
-        last_values = None
-        last_tv = None
-        
-        #print("purgeUpdates: updates:")
-        #for upd in updates:
-        #    print("   ", upd)
-        
-        for upd in updates:
-            chn, tv, data = upd
-            if chn != last_chan:
-                last_chan = chn
-                last_tv, last_values = my_data_dict.get(chn, (None, None))
-
-            close = False
-            if last_values:
-                close = True
-                if tolerances:
-                    for j, x in enumerate(last_values):
-                        new = data[j]
-                        if x != new:
-                            close = False
-                            if type(x) in (type(1), type(1.0)):
-                                t = tolerances[j]
-                                #print 'tolerance[%d] = %s (%s)' % (
-                                #        j, t, type(t))
-                                if t and t > 0:
-                                    close = abs(x-new) <= t
-                        if not close:   break
-                else:
-                    close = last_values == data
-            if not close:
-                last_values = data
-                last_tv = tv
-                new_updates.append(upd)
+        new_updates = purge_updates(updates, my_data_dict, tolerances)
         self.T['purgeUpdates'].end()
         #print "pudates purged from %s to %s" % (len(updates), len(new_updates))
         return new_updates    
@@ -584,6 +1121,7 @@ class CDSnapshot:
         #print "pudates purged from %s to %s" % (len(updates), len(new_updates))
         return new_updates    
         
+    @on_primary
     def addUpdates(self, updates, tolerances):
         #
         # IMPORTANT: updates must be sorted by channel and then by tv
@@ -600,34 +1138,23 @@ class CDSnapshot:
         #print ('updates after purge:', len(updates))
 
         data_columns = self.Table.columns()
-        format = ["%s" % (self.Id,), "%d", "%s"] + ["%s"]*len(data_columns)
-        format = '\t'.join(format)
-        lines = []
-        for channel, tv, data in updates:
-            line = format % ((channel, tv) + data)
-            lines.append(line)
-        #print 'updates lines:', len(lines)    
-        data = io.StringIO('\n'.join(lines))
-        #print 'insering..'
-        #print "addUpdates: data: %s" % (lines,)
-        c = self.Table.copy_from(data, "%t_update", 
+        rows = ((self.Id, channel, tv) + tuple(data) for channel, tv, data in updates)
+        c = self.Table.copyRows(rows, "%t_update", 
             ['__snapshot_id', '__channel', '__tv']+data_columns)
         c.execute("commit")
         self.T['addUpdates'].end()
 
+    @on_primary
     def copyUpdatesFrom(self, s, tmin):
         data_columns = self.Table.columns()
         columns = ','.join(["__channel, __tv, __tr"] + data_columns)
-        format = ["%s" % (self.Id,), "%d", "%s", "%s"] + ["%s"]*len(data_columns)
-        format = '\t'.join(format)
-        lines = []
+        rows = []       # read all before copying, the cursor and COPY share the connection
         sql = "select distinct on (__channel, __tv) " + columns + """ from %t_update
                                 where __snapshot_id = %s and __tv >= %s
                                 order by __channel, __tv, __tr desc"""
-        c = self.Table.execute(sql, (s.Id, tmin))
-        tup = c.fetchone()
-        while tup:
-            lines.append(format % tup)
+        c = self.Table.execute(sql, (s.Id, tmin), server_side=True)
+        for tup in cursor_iterator(c):
+            rows.append((self.Id,) + tuple(tup))
             if self.Updates:
                 channel = tup[0]
                 tv = tup[1]
@@ -637,10 +1164,8 @@ class CDSnapshot:
                     lst = []
                     self.Updates[channel] = lst
                 lst.append((tv, values))
-            tup = c.fetchone()
                 
-        lines = io.StringIO('\n'.join(lines))
-        c = self.Table.copy_from(lines, "%t_update", 
+        c = self.Table.copyRows(rows, "%t_update", 
             ['__snapshot_id', '__channel', '__tv', '__tr'] + data_columns)
         
     def addData__(self, data):
@@ -665,6 +1190,7 @@ class CDSnapshot:
         self.T['addData'].end()
         self.Data.update(data)
         
+    @on_primary
     def addData(self, data):
         # data: [(channel, (data, ...)),...]
         data = list(data)
@@ -759,10 +1285,148 @@ class Segment:
             if flag == 1 and (t1 == None or t1 > t0)]
         
                         
+class CDSnapshotCatalog:
+    #
+    # Process-wide in-memory copy of the snapshot list of a table: (id, tv, tv_end, tr, deleted, type)
+    # of all not deleted snapshots and their tags. Answers findSnapshot() and snapshotsInInterval()
+    # without DB queries, using bisect over snapshots sorted by tv.
+    #
+    # The catalog is reloaded when the snapshot or tag lists change. This is detected by polling
+    # a cheap signature query, at most once every RefreshInterval seconds. Snapshots created
+    # and tags added through this process invalidate the catalog immediately.
+    #
+
+    RefreshInterval = 5.0       # seconds
+
+    Catalogs = {}               # {(dsn, table name): catalog}
+    CatalogsLock = threading.Lock()
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Signature = None
+        self.LastCheck = None
+        self.Version = 0        # incremented by invalidate()
+        self.State = ({}, {})   # ({data_type: (tvs, infos, best, patches)}, {snapshot id: set(tags)})
+
+    @staticmethod
+    def key(table):
+        return (table.DB.connect().dsn, table.Name)
+
+    @staticmethod
+    def forTable(table):
+        key = CDSnapshotCatalog.key(table)
+        with CDSnapshotCatalog.CatalogsLock:
+            catalog = CDSnapshotCatalog.Catalogs.get(key)
+            if catalog is None:
+                catalog = CDSnapshotCatalog.Catalogs[key] = CDSnapshotCatalog()
+        catalog.refresh(table)
+        return catalog
+
+    @staticmethod
+    def invalidate(table):
+        with CDSnapshotCatalog.CatalogsLock:
+            catalog = CDSnapshotCatalog.Catalogs.get(CDSnapshotCatalog.key(table))
+        if catalog is not None:
+            with CDSnapshotCatalog.CatalogsLock:
+                catalog.Version += 1
+                catalog.LastCheck = None
+                catalog.Signature = None
+
+    def refresh(self, table):
+        with self.Lock:
+            if self.LastCheck is not None and time.time() < self.LastCheck + self.RefreshInterval:
+                return
+            version = self.Version
+            c = table.execute("""select count(*), max(__id), max(__tr), count(*) filter (where __deleted),
+                                        (select count(*) from %t_tag_snapshot)
+                                    from %t_snapshot""")
+            signature = c.fetchone()
+            if signature != self.Signature:
+                self.load(table)
+            with CDSnapshotCatalog.CatalogsLock:
+                # if the catalog was invalidated while loading, the signature may predate the change,
+                # keep it invalid so that the next call checks again
+                if version == self.Version:
+                    self.Signature = signature
+                    self.LastCheck = time.time()
+
+    def load(self, table):
+        c = table.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
+                            where not __deleted""")
+        by_type = {}
+        for info in c.fetchall():
+            by_type.setdefault(info[5], []).append(info)
+        types = {}
+        for data_type, infos in by_type.items():
+            infos.sort(key=lambda x: x[1])          # by tv
+            tvs = [x[1] for x in infos]
+            best = []       # best[i]: index of the snapshot without tv_end with latest tr among infos[:i+1]
+            b = None
+            for i, x in enumerate(infos):
+                if x[2] is None and (b is None or x[3] > infos[b][3]):
+                    b = i
+                best.append(b)
+            patches = [i for i, x in enumerate(infos) if x[2] is not None]     # snapshots with tv_end
+            types[data_type] = (tvs, infos, best, patches)
+
+        c = table.execute("select __snapshot_id, __tag_name from %t_tag_snapshot")
+        tags = {}
+        for sid, tag in c.fetchall():
+            tags.setdefault(sid, set()).add(tag)
+        self.State = (types, tags)
+
+    def findSnapshot(self, t, tag=None, tr=None, data_type=None):
+        # returns info tuple of the snapshot findSnapshot() would find, or None
+        types, tags = self.State
+        index = types.get(data_type)
+        if index is None:   return None
+        tvs, infos, best, patches = index
+        n = bisect_right(tvs, t)            # infos[:n] have tv <= t
+        if n == 0:  return None
+        found = None
+        if tag is None and tr is None:
+            if best[n-1] is not None:
+                found = infos[best[n-1]]
+            candidates = [infos[i] for i in patches[:bisect_left(patches, n)]]
+        else:
+            candidates = infos[:n]
+        for info in candidates:
+            if (info[2] is None or info[2] > t) and (found is None or info[3] > found[3]):
+                if tag is not None:
+                    if tag not in tags.get(info[0], ()):    continue
+                elif tr is not None and info[3] > tr:
+                    continue
+                found = info
+        return found
+
+    def snapshotsInInterval(self, t1, t2, tag=None, tr=None, data_type=None):
+        # returns info tuples of snapshots beginning between t1 and t2, ordered by tr
+        types, tags = self.State
+        index = types.get(data_type)
+        if index is None or t2 is None:     return []
+        tvs, infos, best, patches = index
+        lst = []
+        for info in infos[bisect_left(tvs, t1):bisect_left(tvs, t2)]:
+            if info[2] is None or info[2] > t1:
+                if tag is not None:
+                    if tag not in tags.get(info[0], ()):    continue
+                elif tr is not None and info[3] >= tr:
+                    continue
+                lst.append(info)
+        lst.sort(key=lambda x: x[3])
+        return lst
+
 class CDTable:
 
     MAXUPDATES = 1000000
 
+    # indexes added after the original schema, createIndexes() adds them to existing tables
+    CreateIndexes = """
+create index if not exists %T_update_channel_inx on %t_update (__channel, __tv);
+create index if not exists %T_update_tr_inx on %t_update (__tr);
+create index if not exists %T_snapshot_tr_inx on %t_snapshot (__tr);
+"""
+
     CreateTables = """
 create table %t_snapshot
 (   
@@ -808,7 +1472,7 @@ create table %t_update
 
 create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
 
-"""
+""" + CreateIndexes
 
 
     DropTables = """
@@ -822,6 +1486,8 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
     def __init__(self, db, name, columns):
         self.Name = name
         self.Columns = columns
+        self.ColumnTypes = None         # {column: SQL type}, read from the DB when needed
+        self.UpdateColumnTypes = None   # {column: SQL type} for all columns of the update table
         self.DB = db
         words = name.split(".",1)
         if len(words) == 2:
@@ -843,6 +1509,7 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         if not columns:
             raise ValueError("Not a conditions DB table (update table not found)")
         #print "readDataColumnsFromDB(%s): columns: %s" % (self.Name, columns)
+        self.ColumnTypes = dict((x[0], x[1]) for x in columns)
         columns = [x[0] for x in columns]
         for c in ("__snapshot_id","__tv","__channel","__tr"):
             if c in columns:
@@ -855,12 +1522,144 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
     def columns(self):
         return self.Columns
 
-    def execute(self, sql, args=()):
+    def dataColumns(self, columns=None):
+        # returns the list of data columns to read: all table columns or the projection
+        if columns is None:
+            return self.columns()
+        unknown = [c for c in columns if c not in self.Columns]
+        if unknown:
+            raise ValueError("Unknown column(s): %s" % (",".join(unknown),))
+        return list(columns)
+
+    def columnTypes(self):
+        # returns {column: SQL type} for the data columns
+        if self.ColumnTypes is None:
+            dig = DbDig(self.DB.connect())
+            ns = self.Namespace or 'public'
+            self.ColumnTypes = dict((x[0], x[1]) for x in dig.columns(ns, self.Name + "_update"))
+        return dict((c, self.ColumnTypes.get(c)) for c in self.columns())
+
+    ArrayTypes = {
+        "smallint":         "int16",
+        "integer":          "int32",
+        "bigint":           "int64",
+        "real":             "float32",
+        "double precision": "float64",
+        "boolean":          "bool"
+    }
+
+    def makeArrays(self, tuples, columns=None):
+        # tuples: iterator [(channel, tv, data, ...),...]
+        # returns {"channel": int32 array, "tv": float64 array of epoch times, column: array, ...}
+        # columns of types without NumPy equivalent are returned as object arrays
+        if numpy is None:
+            raise ImportError("NumPy is required for array results")
+        types = self.columnTypes()
+        columns = self.dataColumns(columns)
+        dtypes = ["int32", "float64"] + [self.ArrayTypes.get(types[c], object) for c in columns]
+        tuples = ((tup[0], epoch(tup[1])) + tuple(tup[2:]) for tup in tuples)
+        arrays = tuples_to_arrays(tuples, dtypes, self.DB.IterSize)
+        return dict(zip(["channel", "tv"] + columns, arrays))
+
+    def getDataArrays(self, t, tag=None, tr=None, data_type=None, channel_range=None, conditions=[],
+                    channels=None, single_query=False, columns=None):
+        # returns same data as getDataIter() as NumPy arrays, see makeArrays()
+        return self.makeArrays(self.getDataIter(t, tag=tag, tr=tr, data_type=data_type, 
+                    channel_range=channel_range, conditions=conditions, channels=channels,
+                    single_query=single_query, columns=columns), columns)
+
+    def getDataIntervalArrays(self, t1, t2, tag=None, tr=None, data_type=None, channel_range=None,
+                    conditions = [], channels = None, sort = True, columns = None):
+        # returns same data as getDataInterval() as NumPy arrays, see makeArrays()
+        # sort: sort by channel, tv like getDataInterval()
+        data = self.getDataIntervalIter(t1, t2, tag=tag, tr=tr, data_type=data_type, 
+                            channel_range=channel_range, conditions=conditions, channels=channels,
+                            columns=columns)
+        arrays = self.makeArrays(((channel, tv) + tuple(values) for channel, tv, values in data), columns)
+        if sort:
+            order = numpy.lexsort((arrays["tv"], arrays["channel"]))
+            arrays = dict((name, a[order]) for name, a in arrays.items())
+        return arrays
+
+    ConditionOperators = ("=", "!=", "<>", "<", "<=", ">", ">=")
+
+    def filterSQL(self, tr=None, channel_range=None, conditions=[], alias=None, channels=None):
+        # returns (sql, args): " and ..." where clause with bind parameters, so that the SQL text
+        # depends only on which filters are used and not on their values
+        # tr: record time, used with the update table only
+        # channel_range: (cmin, cmax), either can be None
+        # channels: [channel or (cmin, cmax),...], selects channels listed or in any of the ranges
+        # conditions: [(column, op, value),...], column must be a data column of the table
+        prefix = alias + "." if alias else ""
+        sql = ""
+        args = []
+        if tr:
+            # same as the literal used before: no time zone, whole seconds
+            sql += " and %s__tr < %%s " % (prefix,)
+            args.append(tr.strftime("%Y-%m-%d %H:%M:%S"))
+        if channel_range:
+            cmin, cmax = channel_range
+            if cmin is not None:
+                sql += " and %s__channel >= %%s " % (prefix,)
+                args.append(cmin)
+            if cmax is not None:
+                sql += " and %s__channel <= %%s " % (prefix,)
+                args.append(cmax)
+        if channels:
+            terms = []
+            singles = [c for c in channels if not isinstance(c, (tuple, list))]
+            if singles:
+                terms.append("%s__channel = any(%%s)" % (prefix,))
+                args.append(singles)
+            for c0, c1 in [c for c in channels if isinstance(c, (tuple, list))]:
+                if c0 is None and c1 is None:
+                    terms.append("true")
+                elif c0 is None:
+                    terms.append("%s__channel <= %%s" % (prefix,))
+                    args.append(c1)
+                elif c1 is None:
+                    terms.append("%s__channel >= %%s" % (prefix,))
+                    args.append(c0)
+                else:
+                    terms.append("%s__channel between %%s and %%s" % (prefix,))
+                    args += [c0, c1]
+            sql += " and (" + " or ".join(terms) + ") "
+        columns = self.columns()
+        for column, op, value in conditions:
+            if column not in columns:
+                raise ValueError("Unknown column in condition: %s" % (column,))
+            if op not in self.ConditionOperators:
+                raise ValueError("Unsupported operator in condition: %s" % (op,))
+            sql += " and %s%s %s %%s " % (prefix, column, op)
+            args.append(value)
+        return sql, args
+
+    def execute(self, sql, args=(), server_side=False, prepared=None, read=None):
         #print "Table.execute(%s, %s)" % (sql, args)
-        return self.DB.execute(self.Name, sql, args)
-
-    def copy_from(self, data, table, columns):
-        return self.DB.copy_from(self.Name, data, table, columns)
+        return self.DB.execute(self.Name, sql, args, server_side=server_side, prepared=prepared, read=read)
+
+    def copy_from(self, data, table, columns, binary=False):
+        return self.DB.copy_from(self.Name, data, table, columns, binary=binary)
+
+    def copyRows(self, rows, table, columns):
+        # rows: iterator [(value, ...),...] for the columns of the update table
+        # streams the rows with binary COPY if all column types have binary encoders, text COPY otherwise
+        writer = self.copyWriter(columns)
+        if writer is not None:
+            return self.copy_from(CopyStream(writer.chunks(rows)), table, columns, binary=True)
+        return self.copy_from(CopyStream(text_copy_chunks(rows)), table, columns)
+
+    def copyWriter(self, columns):
+        # returns PGCopyWriter for the columns of the update table, or None if binary COPY
+        # can not be used for them
+        if self.UpdateColumnTypes is None:
+            dig = DbDig(self.DB.connect())
+            ns = self.Namespace or 'public'
+            self.UpdateColumnTypes = dict((x[0], x[1]) for x in dig.columns(ns, self.TableName + "_update"))
+        types = [self.UpdateColumnTypes.get(c) for c in columns]
+        if None in types:
+            return None
+        return PGCopyWriter.forTypes(types, session_timezone(self.DB.connect()))
 
     @staticmethod
     def create(db, name, column_types, owner, grants = {}, drop_existing=False):
@@ -902,6 +1701,10 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         return True
         
     exists = validate       # alias
+
+    def createIndexes(self):
+        c = self.execute(self.CreateIndexes)
+        c.execute("commit")
             
     def createTables(self, column_types, owner = None, grants = {}, 
                     drop_existing=False):
@@ -986,6 +1789,21 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         return sql.replace("%t", table).replace("%T", table)
 
     def purgeShadowedSnapshots(self, lst):
+        # lst: [snapshot, ...]
+        # removes snapshots shadowed by a later (by tr) snapshot with earlier or same tv
+        # scans the list backwards keeping minimum tv of later snapshots. O(n log n) for sorting
+        lst = sorted(lst, key=lambda x: x.Tr)
+        out = []
+        min_tv = None
+        for s in reversed(lst):
+            if min_tv is None or s.Tv < min_tv:
+                out.append(s)
+                min_tv = s.Tv
+        out.reverse()
+        return out
+        
+    def purgeShadowedSnapshots_(self, lst):
+        # original O(n^2) version of purgeShadowedSnapshots(), kept for benchmarking
         # lst: [snapshot, ...]
         # make sure snapshots are ordered by tr
         lst = sorted(lst, key=lambda x: x.Tr)               #lst.sort(lambda x,y:    cmp(x.Tr, y.Tr))
@@ -1005,12 +1823,45 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         return out
         
     def overlaySnapshots(self, lst):
-        out = []        # returns list of Segments - sorted by tv. tend can be None, 
-                        # same snapshot can appear many times due to patches
-                        # assumes snapshots are ordered by Tr, ascending
-        # sort list by Tr, so subsequent snapshots override previous ones, if there is an overlap
-        #lst = sorted(lst, key=lambda s: s.Tr)
-                        
+        # returns list of Segments - sorted by tv. tend can be None, 
+        # same snapshot can appear many times due to patches
+        # assumes snapshots are ordered by Tr, ascending, so subsequent snapshots override previous ones
+        #
+        # sweep line over snapshot begin/end times: at any time, the segment belongs to the
+        # latest snapshot in the list covering it. Active snapshots are kept in a heap by their
+        # position in the list, ended ones are removed from the heap lazily. O(n log n)
+        
+        events = {}         # {t: ([begin index,...], [end index,...])}
+        for i, sn in enumerate(lst):
+            if sn.Tv_end != None and sn.Tv_end <= sn.Tv:
+                continue            # empty validity interval
+            events.setdefault(sn.Tv, ([], []))[0].append(i)
+            if sn.Tv_end != None:
+                events.setdefault(sn.Tv_end, ([], []))[1].append(i)
+
+        out = []
+        active = []         # heap of -index
+        ended = set()
+        current, t_begin = None, None
+        for t in sorted(events.keys()):
+            begins, ends = events[t]
+            ended.update(ends)
+            for i in begins:
+                heapq.heappush(active, -i)
+            while active and -active[0] in ended:
+                heapq.heappop(active)
+            top = -active[0] if active else None
+            if top != current:
+                if current is not None:
+                    out.append(Segment(lst[current], t_begin, t))
+                current, t_begin = top, t
+        if current is not None:
+            out.append(Segment(lst[current], t_begin, None))
+        return out
+
+    def overlaySnapshots_(self, lst):
+        # original O(n^2) version of overlaySnapshots(), kept for benchmarking
+        out = []
         for sn in lst:
             out1 = []
             for sg in out:
@@ -1023,37 +1874,31 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                                                
     def snapshots(self, tag=None, tr=None, data_type=None):
         #print "snapshots: name=%s" % (self.Name,)
-        type_where = ''
+        type_where, type_args = '', []
         if data_type != None:
             #print("Table.snapshots(): data_type:", type(data_type), data_type)
-            type_where = " and __type = '%s' " % (data_type,)
+            type_where, type_args = " and __type = %s ", [data_type]
             
         if tag != None:
-            c = self.execute("""select s.__id 
+            c = self.execute("select " + CDSnapshot.infoColumns("s") + """
                             from %t_snapshot s, %t_tag_snapshot t
                             where not __deleted
                                 and s.__id = t.__snapshot_id
                                 and t.__tag_name = %s """ +
                                 type_where + 
-                            "order by s.__tr", (tag,))      
+                            "order by s.__tr", [tag] + type_args)      
         elif tr != None:      
-            c = self.execute("""select __id from %t_snapshot
+            c = self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
                             where not __deleted
                                 and __tr <= %s """ + type_where + 
-                            "order by __tr", (tr,))
+                            "order by __tr", [tr] + type_args)
         else:        
-            c = self.execute("""select __id from %t_snapshot
+            c = self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
                             where not __deleted """ +
                                 type_where + 
-                            "order by __tr", ())
+                            "order by __tr", type_args)
                             
-        snapshots = []
-        for tup in c.fetchall():
-            snapshot = CDSnapshot(self, tup[0])
-            snapshot.fetchInfo()
-            snapshots.append(snapshot)
-        
-        return snapshots
+        return [CDSnapshot.fromInfo(self, tup) for tup in c.fetchall()]
 
     def snapshotCount(self):
             c = self.execute("""select count(*) from %t_snapshot where not __deleted""", ())
@@ -1068,15 +1913,31 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         return [x[0] for x in c.fetchall()]
     
 
+    def snapshotCatalog(self, *times):
+        # returns the process-wide snapshot catalog if the DB is configured to use it,
+        # and the times can be compared to the timezone-aware times stored in the catalog.
+        # Writes and other calls on the primary do not use the catalog: it can be up to
+        # RefreshInterval behind snapshots created by other processes
+        if not self.DB.UseSnapshotCatalog or self.DB.onPrimary():  return None
+        for t in times:
+            if t is not None and getattr(t, "tzinfo", None) is None:
+                return None
+        return CDSnapshotCatalog.forTable(self)
+
     def findSnapshot(self, t, tag=None, tr=None, data_type=None):
-        type_where = " and __type is null "
+        catalog = self.snapshotCatalog(t, tr)
+        if catalog is not None:
+            info = catalog.findSnapshot(t, tag=tag, tr=tr, data_type=data_type)
+            return None if info is None else CDSnapshot.fromInfo(self, info)
+
+        type_where, type_args = " and __type is null ", []
         if data_type != None:
-            type_where = " and __type = '%s' " % (data_type,)
+            type_where, type_args = " and __type = %s ", [data_type]
             
         #print type_where
             
         if tag != None:
-            c = self.execute("""select s.__id 
+            c = self.execute("select " + CDSnapshot.infoColumns("s") + """
                             from %t_snapshot s, %t_tag_snapshot t
                             where not __deleted
                                 and (s.__tv_end is null or s.__tv_end > %s)
@@ -1084,101 +1945,80 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                                 and s.__id = t.__snapshot_id
                                 and t.__tag_name = %s """ +
                                 type_where + 
-                            "order by s.__tr desc limit 1", (t, t, tag))      
+                            "order by s.__tr desc limit 1", [t, t, tag] + type_args, prepared="find_snapshot")      
         elif tr != None:      
-            c = self.execute("""select __id from %t_snapshot
+            c = self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
                             where not __deleted
                                 and (__tv_end is null or __tv_end > %s)
                                 and __tv <= %s
                                 and __tr <= %s """ + type_where + 
-                            "order by __tr desc limit 1", (t, t, tr))
+                            "order by __tr desc limit 1", [t, t, tr] + type_args, prepared="find_snapshot")
         else:        
-            c = self.execute("""select __id from %t_snapshot
+            c = self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
                             where not __deleted
                                 and (__tv_end is null or __tv_end > %s)
                                 and __tv <= %s """ +
                                 type_where + 
-                            "order by __tr desc limit 1", (t, t))
+                            "order by __tr desc limit 1", [t, t] + type_args, prepared="find_snapshot")
         
         tup = c.fetchone()
         if not tup: return None
-        snapshot = CDSnapshot(self, tup[0])
-        snapshot.fetchInfo()
-        return snapshot
+        return CDSnapshot.fromInfo(self, tup)
 
-    def findSnapshots(self, t1, t2, tag=None, tr=None, data_type=None):
-        #print "findSnapshots(%s, %s, %s, %s, %s)" % (t1, t2, tag, tr, data_type)
-        s0 = self.findSnapshot(t1, tag=tag, tr=tr, data_type=data_type)
-        
-        #print "s0=", s0
+    def findSnapshotsAtTimes(self, times, tag=None, tr=None, data_type=None):
+        # returns [snapshot or None,...], same as findSnapshot() for each time, with one query
+        catalog = self.snapshotCatalog(tr, *times)
+        if catalog is not None:
+            infos = [catalog.findSnapshot(t, tag=tag, tr=tr, data_type=data_type) for t in times]
+            return [None if info is None else CDSnapshot.fromInfo(self, info) for info in infos]
+        if not times:   return []
 
-        type_where = " and __type is null "
+        where, args = " and s.__type is null ", []
         if data_type != None:
-            type_where = " and __type = '%s' " % (data_type,)
-
+            where, args = " and s.__type = %s ", [data_type]
         if tag != None:
-            #print "tag"
-            c = self.execute("""
-                        select s.__id, s.__tv, s.__tr
-                            from %t_snapshot s, %t_tag_snapshot t
-                            where not __deleted
-                                and s.__tv >= %s
-                                and s.__tv < %s
-                                and (s.__tv_end is null or s.__tv_end > %s)
-                                and s.__id = t.__snapshot_id
-                                and t.__tag_name = %s """ + type_where +
-                            "order by s.__tr", (t1, t2, t1, tag))      
-        elif tr != None:      
-            #print "tr"
-            c = self.execute("""
-                        select __id, __tv, __tr
-                            from %t_snapshot
-                            where not __deleted
-                                and __tv >= %s
-                                and __tv < %s
-                                and (__tv_end is null or __tv_end > %s)
-                                and __tr < %s """ + type_where +
-                            "order by __tr", (t1, t2, t1, tr))
-        else:        
-            #print "else"
-            c = self.execute("""
-                        select __id, __tv, __tr
-                            from %t_snapshot
-                            where not __deleted
-                                and __tv >= %s
-                                and __tv < %s
-                                and (__tv_end is null or __tv_end > %s) """ + type_where +
-                            "order by __tr", (t1, t2, t1))
-
-        lst = c.fetchall()
-        #print "lst=", lst
-        if s0:
-            lst = [(sid, tv, tr) for sid, tv, tr in lst if sid != s0.Id]    # remove s0 if it is there
-
-        lst = [CDSnapshot(self, sid, tv=tv, tr=tr).fetchInfo() for sid, tv, tr in lst]
-        if s0:
-            lst = [s0] + lst
-        #print "other snapshots=",lst
-        
-        #print "lst1=", lst
-        out = self.purgeShadowedSnapshots(lst)
-        #print "out=", out
+            where += """ and exists (select 1 from %t_tag_snapshot tg
+                                    where tg.__snapshot_id = s.__id and tg.__tag_name = %s) """
+            args.append(tag)
+        if tr != None:
+            where += " and s.__tr <= %s "
+            args.append(tr)
+        c = self.execute("select tt.i, " + CDSnapshot.infoColumns("s") + """
+                            from unnest(%s::timestamptz[]) with ordinality as tt(t, i)
+                            cross join lateral (
+                                select * from %t_snapshot s
+                                    where not s.__deleted
+                                        and (s.__tv_end is null or s.__tv_end > tt.t)
+                                        and s.__tv <= tt.t """ + where + """
+                                    order by s.__tr desc limit 1
+                            ) s""", [list(times)] + args)
+        out = [None] * len(times)
+        for tup in c.fetchall():
+            out[tup[0]-1] = CDSnapshot.fromInfo(self, tup[1:])
         return out
-            
-    def findSegments(self, t1, t2, tag=None, tr=None, data_type=None):
-        #print "findSnapshots(%s, %s, %s, %s, %s)" % (t1, t2, tag, tr, data_type)
+
+    def snapshotsInInterval(self, t1, t2, tag=None, tr=None, data_type=None):
+        # returns [snapshot, ...]: the snapshot found for t1 first, then snapshots
+        # beginning between t1 and t2, ordered by tr
         s0 = self.findSnapshot(t1, tag=tag, tr=tr, data_type=data_type)
         
         #print "s0=", s0
 
-        type_where = " and __type is null "
+        catalog = self.snapshotCatalog(t1, t2, tr)
+        if catalog is not None:
+            lst = [CDSnapshot.fromInfo(self, info) 
+                    for info in catalog.snapshotsInInterval(t1, t2, tag=tag, tr=tr, data_type=data_type)]
+            if s0:
+                lst = [s0] + [s for s in lst if s.Id != s0.Id]
+            return lst
+
+        type_where, type_args = " and __type is null ", []
         if data_type != None:
-            type_where = " and __type = '%s' " % (data_type,)
+            type_where, type_args = " and __type = %s ", [data_type]
 
         if tag != None:
             #print "tag"
-            c = self.execute("""
-                        select s.__id, s.__tv, s.__tr
+            c = self.execute("select " + CDSnapshot.infoColumns("s") + """
                             from %t_snapshot s, %t_tag_snapshot t
                             where not __deleted
                                 and s.__tv >= %s
@@ -1186,53 +2026,60 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                                 and (s.__tv_end is null or s.__tv_end > %s)
                                 and s.__id = t.__snapshot_id
                                 and t.__tag_name = %s """ + type_where +
-                            "order by s.__tr", (t1, t2, t1, tag))      
+                            "order by s.__tr", [t1, t2, t1, tag] + type_args)      
         elif tr != None:      
             #print "tr"
-            c = self.execute("""
-                        select __id, __tv, __tr
+            c = self.execute("select " + CDSnapshot.infoColumns() + """
                             from %t_snapshot
                             where not __deleted
                                 and __tv >= %s
                                 and __tv < %s
                                 and (__tv_end is null or __tv_end > %s)
                                 and __tr < %s """ + type_where +
-                            "order by __tr", (t1, t2, t1, tr))
+                            "order by __tr", [t1, t2, t1, tr] + type_args)
         else:        
             #print "else"
-            c = self.execute("""
-                        select __id, __tv, __tr
+            c = self.execute("select " + CDSnapshot.infoColumns() + """
                             from %t_snapshot
                             where not __deleted
                                 and __tv >= %s
                                 and __tv < %s
                                 and (__tv_end is null or __tv_end > %s) """ + type_where +
-                            "order by __tr", (t1, t2, t1))
-
-        lst = c.fetchall()
-        #print "lst=", lst
-        if s0:
-            lst = [(sid, tv, tr) for sid, tv, tr in lst if sid != s0.Id]    # remove s0 if it is there
+                            "order by __tr", [t1, t2, t1] + type_args)
 
-        lst = [CDSnapshot(self, sid, tv=tv, tr=tr).fetchInfo() for sid, tv, tr in lst]
-        #print "findSegments: found snapshots:", lst
+        lst = [CDSnapshot.fromInfo(self, tup) for tup in c.fetchall()]
         if s0:
-            #print "findSegments: s0:", s0
-            lst = [s0] + lst
-        #print "other snapshots=",lst
-        
-        lst = self.overlaySnapshots(lst)
-        #print "findSegments: segments:", lst
+            lst = [s0] + [s for s in lst if s.Id != s0.Id]    # remove s0 if it is there
         return lst
+
+    def findSnapshots(self, t1, t2, tag=None, tr=None, data_type=None):
+        #print "findSnapshots(%s, %s, %s, %s, %s)" % (t1, t2, tag, tr, data_type)
+        lst = self.snapshotsInInterval(t1, t2, tag=tag, tr=tr, data_type=data_type)
+        return self.purgeShadowedSnapshots(lst)
             
-    def getDataIter(self, t, tag=None, tr=None, data_type=None, channel_range=None, conditions=[]):
+    def findSegments(self, t1, t2, tag=None, tr=None, data_type=None):
+        #print "findSegments(%s, %s, %s, %s, %s)" % (t1, t2, tag, tr, data_type)
+        lst = self.snapshotsInInterval(t1, t2, tag=tag, tr=tr, data_type=data_type)
+        return self.overlaySnapshots(lst)
+            
+    def getDataIter(self, t, tag=None, tr=None, data_type=None, channel_range=None, conditions=[],
+                    single_query=False, channels=None, columns=None):
         # returns iterator [(channel, tv, data, ...)] unsorted
+        # channels: [channel or (cmin, cmax),...], optional, in addition to channel_range
+        # columns: data columns to return, default: all
         #print "getData: tr=%s" % (tr,)
 
+        if single_query:
+            for tup in self.getDataIterSingleQuery(t, tag=tag, tr=tr, data_type=data_type,
+                        channel_range=channel_range, conditions=conditions, channels=channels,
+                        columns=columns):
+                yield tup
+            return
+
         if data_type != None:
             # merge with common data
             common_data = self.getDataIter(t, tag, tr, None, channel_range = channel_range,
-                    conditions = conditions)
+                    conditions = conditions, channels = channels, columns = columns)
             #print common_data, common_tv
             for tup in common_data:
                 yield tup
@@ -1240,13 +2087,222 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         s = self.findSnapshot(t, tag=tag, tr=tr, data_type=data_type)
         #print "table.getDataIter: found snapshot: %s" % (s,)
         if s != None:
-            for tup in s.getValuesIter(t, tr=tr, channel_range = channel_range, conditions = conditions):
+            for tup in s.getValuesIter(t, tr=tr, channel_range = channel_range, conditions = conditions,
+                                    channels = channels, columns = columns):
                 #print "table.getDataIter: yielding %s" % (tup,)
                 yield tup
-        
+
+    def getStateIter(self, t, tag=None, tr=None, data_type=None, channel_range=None, conditions=[],
+                    channels=None, columns=None):
+        # returns iterator [(channel, tv, data, ...),...] ordered by channel, one tuple per channel,
+        # data for data_type overrides common data
+        def values(dt):
+            s = self.findSnapshot(t, tag=tag, tr=tr, data_type=dt)
+            if s is None:   return iter([])
+            return s.getValuesIter(t, tr=tr, channel_range=channel_range, conditions=conditions,
+                                channels=channels, columns=columns)
+        if data_type is None:
+            return values(None)
+        return merge_by_channel(values(None), values(data_type))
+
+    def diff(self, a, b, channel_range=None, conditions=[], channels=None, columns=None):
+        # a, b: (t, tag, tr, data_type), trailing items can be omitted
+        # returns iterator [(channel, (tv, data, ...) or None, (tv, data, ...) or None),...] ordered by channel
+        # for channels with different data at a and b, or present at one of them only.
+        # Both states are read ordered by channel and compared as they arrive
+        def state(spec):
+            t, tag, tr, data_type = (tuple(spec) + (None,)*4)[:4]
+            return self.getStateIter(t, tag=tag, tr=tr, data_type=data_type, channel_range=channel_range,
+                        conditions=conditions, channels=channels, columns=columns)
+        a_iter, b_iter = state(a), state(b)
+        x, y = next(a_iter, None), next(b_iter, None)
+        while x is not None or y is not None:
+            if y is None or (x is not None and x[0] < y[0]):
+                yield (x[0], x[1:], None)
+                x = next(a_iter, None)
+            elif x is None or y[0] < x[0]:
+                yield (y[0], None, y[1:])
+                y = next(b_iter, None)
+            else:
+                if x[2:] != y[2:]:
+                    yield (x[0], x[1:], y[1:])
+                x, y = next(a_iter, None), next(b_iter, None)
+
+    def channelHistoryStream(self, channel, t0, t1, tag=None, tr=None, data_type=None, columns=None,
+                    after_tv=None, max_rows=None):
+        # returns iterator [(tv, data, ...),...] ordered by tv for one data type, with tv >= after_tv.
+        # Same rows as getDataIntervalIter() returns for the channel: the value at t0,
+        # then snapshot data and updates of each segment
+        s = self.findSnapshot(t0, tag=tag, tr=tr, data_type=data_type)
+        if s is not None:
+            for tup in s.getValuesIter(t0, tr=tr, channels=[channel], columns=columns):
+                if after_tv is None or tup[1] >= after_tv:
+                    yield tup[1:]
+
+        data_columns = self.dataColumns(columns)
+        filter_where, filter_args = self.filterSQL(tr=tr)
+        sql = "select distinct on (__tv) " + ','.join(["__tv"] + data_columns) + """ from %t_update
+                    where __channel = %s and __snapshot_id = %s
+                        and __tv > %s and __tv >= %s and __tv <= %s """ + filter_where + \
+                    " order by __tv, __tr desc"
+        limit_args = []
+        if max_rows:
+            sql += " limit %s"      # a parameter, so that the statement is prepared once for all limits
+            limit_args = [max_rows]
+
+        for sg in self.findSegments(t0, t1, tag=tag, tr=tr, data_type=data_type):
+            s = sg.Snapshot
+            s.fetchInfo()
+            ta = max(sg.Tv, t0)
+            tb = sg.Tend
+            if tb == None:  tb = t1
+            elif t1 != None and t1 < tb:    tb = t1
+            if after_tv is not None and tb < after_tv:
+                continue
+            if s.Tv > t0 and s.Tv >= ta and s.Tv < tb and (after_tv is None or s.Tv >= after_tv):
+                for tup in s.getData(channels=[channel], columns=columns):
+                    yield tup[1:]
+            tmin = ta if after_tv is None else max(ta, after_tv)
+            tmax = tb if s.Tv_end is None else min(tb, s.Tv_end)
+            c = self.execute(sql, [channel, s.Id, t0, tmin, tmax] + filter_args + limit_args, 
+                                prepared="channel_history")
+            for tup in c.fetchall():
+                yield tup
+
+    def channelHistory(self, channel, t0, t1, limit=1000, after=None, tag=None, tr=None, data_type=None,
+                    columns=None):
+        # returns ([(tv, data, ...),...], token): up to limit rows of the channel history ordered by tv
+        # token is None after the last page. Otherwise, pass it as "after" to get the next page.
+        # The token is the last tv returned and the number of rows returned with that tv
+        # Raises ValueError for limit < 1 or invalid token
+        if limit < 1:
+            raise ValueError("Invalid limit %s, must be >= 1" % (limit,))
+        after_tv, skip = None, 0
+        if after:
+            try:
+                tv_text, skip = base64.urlsafe_b64decode(after.encode("ascii")).decode("ascii").split("|")
+                after_tv, skip = datetime.datetime.fromisoformat(tv_text), int(skip)
+            except ValueError:      # includes binascii.Error and UnicodeError
+                raise ValueError("Invalid continuation token %s" % (after,))
+        max_rows = limit + skip + 1
+        streams = [self.channelHistoryStream(channel, t0, t1, tag=tag, tr=tr, data_type=None, columns=columns,
+                        after_tv=after_tv, max_rows=max_rows)]
+        if data_type != None:
+            streams.append(self.channelHistoryStream(channel, t0, t1, tag=tag, tr=tr, data_type=data_type, 
+                        columns=columns, after_tv=after_tv, max_rows=max_rows))
+        rows = list(itertools.islice(heapq.merge(*streams, key=lambda tup: tup[0]), max_rows))
+        rows = rows[skip:]
+        token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_tv = rows[-1][0]
+            n = sum(1 for tup in rows if tup[0] == last_tv)
+            if last_tv == after_tv:   n += skip
+            token = base64.urlsafe_b64encode(("%s|%d" % (last_tv.isoformat(), n)).encode("ascii")).decode("ascii")
+        return rows, token
+
+    def getDataAtTimes(self, times, tag=None, tr=None, data_type=None, channel_range=None, 
+                    conditions=[], channels=None, columns=None):
+        # returns [[(channel, tv, data, ...),...] for each time in times], 
+        # for each time, same tuples as getDataIter(), common data first, then data for data_type
+        #
+        # Times are grouped by snapshot and data and updates of each snapshot are read only once
+        times = aware_times(times, self.DB)
+        order = sorted(range(len(times)), key=lambda i: times[i])
+        results = [[] for t in times]
+        types = [None] if data_type is None else [None, data_type]
+        for dt in types:
+            groups = {}         # {snapshot id: (snapshot, [index,...])}, indexes ordered by time
+            snapshots = self.findSnapshotsAtTimes(times, tag=tag, tr=tr, data_type=dt)
+            for i in order:
+                s = snapshots[i]
+                if s is not None:
+                    groups.setdefault(s.Id, (s, []))[1].append(i)
+            for s, indexes in groups.values():
+                values = s.getValuesAtTimes([times[i] for i in indexes], tr=tr, channel_range=channel_range,
+                                conditions=conditions, channels=channels, columns=columns)
+                for i, lst in zip(indexes, values):
+                    results[i] += lst
+        return results
+
+    def getDataIterSingleQuery(self, t, tag=None, tr=None, data_type=None, channel_range=None,
+                    conditions=[], channels=None, columns=None):
+        # returns iterator [(channel, tv, data, ...)], same tuples as getDataIter()
+        #
+        # Snapshot lookup, snapshot data, updates and the data_type override are all
+        # resolved by one SQL statement, so the whole read is one round trip to the DB.
+        # Common data (rank 0) goes first, then data for data_type (rank 1),
+        # same as getDataIter()
+
+        data_columns = self.dataColumns(columns)
+        args = []
+
+        snapshot_selects = []
+        types = [None] if data_type is None else [None, data_type]
+        for rank, dt in enumerate(types):
+            sql = "select s.__id, s.__tv, %d as __rank from %%t_snapshot s" % (rank,)
+            if tag != None:
+                sql += ", %t_tag_snapshot tg"
+            sql += """
+                        where not s.__deleted
+                            and (s.__tv_end is null or s.__tv_end > %s)
+                            and s.__tv <= %s """
+            args += [t, t]
+            if tag != None:
+                sql += " and s.__id = tg.__snapshot_id and tg.__tag_name = %s "
+                args.append(tag)
+            elif tr != None:
+                sql += " and s.__tr <= %s "
+                args.append(tr)
+            if dt is None:
+                sql += " and s.__type is null "
+            else:
+                sql += " and s.__type = %s "
+                args.append(dt)
+            sql += " order by s.__tr desc limit 1"
+            snapshot_selects.append("(" + sql + ")")
+
+        upd_where, upd_args = self.filterSQL(tr=tr, channel_range=channel_range,
+                                    conditions=conditions, alias="u", channels=channels)
+        data_where, data_args = self.filterSQL(channel_range=channel_range,
+                                    conditions=conditions, alias="d", channels=channels)
+
+        upd_columns = ','.join(["u." + c for c in data_columns])
+        data_columns = ','.join(["d." + c for c in data_columns])
+
+        sql = """
+            with snapshots as (
+                """ + "\n union all \n".join(snapshot_selects) + """
+            ),
+            updates as (
+                select distinct on (s.__rank, u.__channel) s.__rank, u.__channel, u.__tv, """ + upd_columns + """
+                    from %t_update u, snapshots s
+                    where u.__snapshot_id = s.__id
+                        and u.__tv <= %s """ + upd_where + """
+                    order by s.__rank, u.__channel, u.__tr desc, u.__tv desc
+            ),
+            snapshot_data as (
+                select s.__rank, d.__channel, s.__tv, """ + data_columns + """
+                    from %t_snapshot_data d, snapshots s
+                    where d.__snapshot_id = s.__id """ + data_where + """
+                        and not exists (select 1 from updates u
+                                where u.__rank = s.__rank and u.__channel = d.__channel)
+            )
+            select * from
+                (   select * from updates
+                    union all
+                    select * from snapshot_data
+                ) as merged
+            order by __rank"""
+        args = args + [t] + upd_args + data_args
+
+        c = self.execute(sql, args, server_side=True, prepared="data_at_time", read=True)
+        for tup in cursor_iterator(c):
+            yield tup[1:]
+
 
     def getDataIntervalIter(self, t1, t2, tag=None, tr=None, data_type=None, channel_range=None,
-                    conditions = []):
+                    conditions = [], channels = None, columns = None):
         # returns [(channel, tv, (data,...)),...]
         #print "tag=", tag, " data_type=", data_type, "%s %s %s" % (t1, t2, tr)
         #print "getDataIntervalIter(t1=%s, t2=%s)" % (t1, t2)
@@ -1260,7 +2316,8 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         
         
         
-        begin_data = self.getDataIter(t1, tag=tag, tr=tr, data_type=data_type, channel_range=channel_range)
+        begin_data = self.getDataIter(t1, tag=tag, tr=tr, data_type=data_type, channel_range=channel_range,
+                                channels=channels, columns=columns)
 
         #print "table.getDataIntervalIter: returned from getData()"
 
@@ -1284,13 +2341,14 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
             elif t2 != None and t2 < tb:    tb = t2
             
             if s.Tv > t1 and s.Tv >= ta and s.Tv < tb:
-                sdata = s.getData(channel_range = channel_range)
+                sdata = s.getData(channel_range = channel_range, channels = channels, columns = columns)
                 #print "table.getDataIntervalIter: got data"
                 for tup in sdata:
                     #print "getDataIntervalIter: yielding1", (tup[0], tup[1], tup[2:])
                     yield (tup[0], tup[1], tup[2:])
 
-            updates = s.getUpdatesInRange(ta, tb, tr, channel_range = channel_range)
+            updates = s.getUpdatesInRange(ta, tb, tr, channel_range = channel_range, channels = channels,
+                                columns = columns)
             for channel, ulst in updates.items():
                 for tv, data in ulst:
                     if tv > t1 and tv >= ta and tv <= tb:
@@ -1299,20 +2357,175 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                 
                 
     def getDataInterval(self, t1, t2, tag=None, tr=None, data_type=None, channel_range=None,
-                    conditions = []):
+                    conditions = [], channels = None, columns = None):
         #
         # returns [(channel, tv, (data,...))] sorted by channel, tv
         #
         lst = sorted(list(self.getDataIntervalIter(t1, t2, tag=tag, tr=tr, data_type=data_type, 
-                            channel_range=channel_range, conditions=conditions)))
+                            channel_range=channel_range, conditions=conditions, channels=channels,
+                            columns=columns)))
         return lst
 
+    def changesHorizon(self):
+        # returns the time before which all transactions of other client sessions which can still
+        # commit rows have ended. __tr defaults to the transaction start time, so rows with an earlier
+        # __tr can not appear any more. Sessions idle in a read only transaction, e.g. ConDB readers,
+        # which never commit, do not count. ConDB write methods take a transaction id first (see
+        # ConDB.beginWrite), other writers are counted once they write or while a statement runs.
+        # Sessions of other users are seen only with the pg_read_all_stats privilege
+        # pg_stat_activity is a snapshot taken once per transaction, clear it first
+        c = self.execute("""select pg_stat_clear_snapshot();
+                            select coalesce(min(xact_start), clock_timestamp()) from pg_stat_activity
+                                where datname = current_database() and pid <> pg_backend_pid()
+                                    and backend_type = 'client backend' and xact_start is not null
+                                    and (backend_xid is not null or state = 'active')""")
+        return c.fetchone()[0]
+
+    def changesSince(self, tr, channel_range=None, channels=None, columns=None, limit=None, after=None):
+        # returns (snapshots, updates, watermark, token) recorded after tr:
+        #   snapshots: [snapshot,...] ordered by tr
+        #   updates: [(snapshot id, channel, tv, tr, data, ...),...] ordered by tr
+        #   watermark: pass it as tr to the next call. It lags the oldest transaction in progress,
+        #       so changes committed later can not have tr <= watermark
+        #   token: None if all updates up to the watermark were returned. Otherwise, more than
+        #       limit updates were found, and the watermark is tr. Pass the token as "after"
+        #       with the same tr to get the next page of updates. Snapshots come with the first page.
+        # Raises ValueError for limit < 1 or invalid token
+        if limit is not None and limit < 1:
+            raise ValueError("Invalid limit %s, must be >= 1" % (limit,))
+        tr = aware_times([tr], self.DB)[0]
+        with self.DB.primary():
+            # pg_stat_activity of a replica does not show the transactions on the primary
+            # the token is the horizon, the (tr, snapshot id, channel, tv) key of the last update returned
+            # and the number of updates returned with that key, which is not unique
+            last, skip = None, 0
+            if after:
+                try:
+                    words = base64.urlsafe_b64decode(after.encode("ascii")).decode("ascii").split("|")
+                    horizon, last_tr, sid, channel, tv, skip = words
+                    horizon = datetime.datetime.fromisoformat(horizon)
+                    last = (datetime.datetime.fromisoformat(last_tr), int(sid), int(channel),
+                                datetime.datetime.fromisoformat(tv))
+                    skip = int(skip)
+                except ValueError:      # includes binascii.Error and UnicodeError
+                    raise ValueError("Invalid continuation token %s" % (after,))
+            else:
+                horizon = self.changesHorizon() - datetime.timedelta(microseconds=1)
+            horizon = max(horizon, tr)
+
+            snapshots = []
+            if last is None:
+                c = self.execute("select " + CDSnapshot.infoColumns() + """ from %t_snapshot
+                                    where __tr > %s and __tr <= %s and not __deleted
+                                    order by __tr""", (tr, horizon))
+                snapshots = [CDSnapshot.fromInfo(self, tup) for tup in c.fetchall()]
+
+            data_columns = self.dataColumns(columns)
+            filter_where, filter_args = self.filterSQL(channel_range=channel_range, channels=channels)
+            sql = "select " + ','.join(["__snapshot_id, __channel, __tv, __tr"] + data_columns) + """ 
+                        from %t_update
+                        where __tr > %s and __tr <= %s """ + filter_where
+            args = [tr, horizon] + filter_args
+            if last is not None:
+                sql += " and (__tr, __snapshot_id, __channel, __tv) >= (%s, %s, %s, %s)"
+                args += list(last)
+            sql += " order by __tr, __snapshot_id, __channel, __tv, ctid"
+            if limit is not None:
+                sql += " limit %s"
+                args.append(limit + skip + 1)
+            c = self.execute(sql, args, server_side=True)
+            updates = list(cursor_iterator(c))[skip:]
+
+        token = None
+        if limit is not None and len(updates) > limit:
+            updates = updates[:limit]
+            sid, channel, tv, last_tr = key = updates[-1][:4]
+            n = sum(1 for tup in updates if tup[:4] == key)
+            if last is not None and (last_tr, sid, channel, tv) == last:   n += skip
+            token = base64.urlsafe_b64encode(("%s|%s|%d|%d|%s|%d" % (horizon.isoformat(), last_tr.isoformat(), 
+                            sid, channel, tv.isoformat(), n)).encode("ascii")).decode("ascii")
+            return snapshots, updates, tr, token
+        return snapshots, updates, horizon, None
+
+    def getDataIntervalBuckets(self, t1, t2, column, buckets, tag=None, tr=None, data_type=None, 
+                    channel_range=None, channels=None):
+        #
+        # Downsampled getDataInterval() for one column, e.g. for plotting.
+        # The interval is split into equal time buckets, bucket i begins at t1 + i*(t2-t1)/buckets.
+        # returns [(channel, bucket, min, max, last tv, last value),...] sorted by channel, bucket,
+        # for buckets with at least one row returned by getDataIntervalIter() for the channel.
+        # The value valid at t1 goes to bucket 0. If t1 == t2, only the values at t1 are returned, in bucket 0.
+        # Updates are aggregated by the DB with width_bucket(), only snapshot data are read row by row
+        # Raises ValueError if t2 is before t1
+        #
+        if t2 < t1:
+            raise ValueError("Invalid interval: %s is before %s" % (t2, t1))
+        column = self.dataColumns([column])[0]
+        e1, e2 = epoch(t1), epoch(t2)
+        stats = {}          # {(channel, bucket): [min, max, last tv, last value]}
+
+        def add(channel, bucket, vmin, vmax, tv, value):
+            st = stats.get((channel, bucket))
+            if st is None:
+                stats[(channel, bucket)] = [vmin, vmax, tv, value]
+            else:
+                if vmin is not None and (st[0] is None or vmin < st[0]):    st[0] = vmin
+                if vmax is not None and (st[1] is None or vmax > st[1]):    st[1] = vmax
+                if tv >= st[2]:
+                    st[2], st[3] = tv, value
+
+        def bucket(tv):
+            b = int((epoch(tv) - e1) * buckets / (e2 - e1))
+            return min(max(b, 0), buckets - 1)
+
+        segments = []
+        if e2 > e1:
+            segments = self.findSegments(t1, t2, tag=tag, tr=tr, data_type=data_type)
+            if data_type != None:
+                segments += self.findSegments(t1, t2, tag=tag, tr=tr, data_type=None)
+                segments.sort(key=lambda x: x.Tv)
+
+        for channel, tv, value in self.getDataIter(t1, tag=tag, tr=tr, data_type=data_type, 
+                            channel_range=channel_range, channels=channels, columns=[column]):
+            add(channel, 0, value, value, tv, value)
+
+        filter_where, filter_args = self.filterSQL(tr=tr, channel_range=channel_range, channels=channels)
+        sql = """select __channel, least(greatest(width_bucket(extract(epoch from __tv), %s, %s, %s), 1), %s) - 1 as b,
+                        min(v), max(v), (array_agg(__tv order by __tv desc))[1], (array_agg(v order by __tv desc))[1]
+                    from (
+                        select distinct on (__channel, __tv) __channel, __tv, """ + column + """ as v
+                            from %t_update
+                            where __snapshot_id = %s
+                                and __tv > %s and __tv >= %s and __tv <= %s """ + filter_where + """
+                            order by __channel, __tv, __tr desc
+                    ) as u
+                    group by __channel, b"""
+        for sg in segments:
+            s = sg.Snapshot
+            s.fetchInfo()
+            ta = max(sg.Tv, t1)
+            tb = sg.Tend
+            if tb == None:  tb = t2
+            elif t2 != None and t2 < tb:    tb = t2
+            if s.Tv > t1 and s.Tv >= ta and s.Tv < tb:
+                for channel, tv, value in s.getData(channel_range=channel_range, channels=channels, 
+                                columns=[column]):
+                    add(channel, bucket(tv), value, value, tv, value)
+            tmax = tb if s.Tv_end is None else min(tb, s.Tv_end)
+            c = self.execute(sql, [e1, e2, buckets, buckets, s.Id, t1, ta, tmax] + filter_args)
+            for channel, b, vmin, vmax, tv, value in c.fetchall():
+                add(channel, b, vmin, vmax, tv, value)
+
+        return [(channel, b) + tuple(st) for (channel, b), st in sorted(stats.items())]
+
+    @on_primary
     def createSnapshot(self, t, prefill, data_type=None, tv_end=None):
         s = CDSnapshot.create(self, t, data_type, tv_end=tv_end)
         s.addData(prefill)
         #print "Added data:", len(data)
         return s
 
+    @on_primary
     def patch(self, data, tend, data_type=None):
         channels = {}
         if data:
@@ -1332,6 +2545,7 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
             #print end_data
             s.addUpdates(end_data, None)
 
+    @on_primary
     def addData(self, data, tolerances = None, data_type=""):
         # data: [(channel, tv, (data, ...)),...]
         # tolerances: (tolerance,...)
@@ -1396,6 +2610,7 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         #s0.printStats()
         return s1
         
+    @on_primary
     def addData_(self, data, tolerances = None, data_type=None):
         # data: [(channel, tv, (data, ...)),...]
         # tolerances: (tolerance,...)
@@ -1427,6 +2642,7 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
         #s0.printStats()
         return s1
                     
+    @on_primary
     def tag(self, tag, comment="", override=False):
 
         if override:
@@ -1446,7 +2662,9 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                 insert into %t_tag_snapshot(__tag_name, __snapshot_id)
                     values(%s, %s)""", (tag, sid))
         self.execute("commit", ())
+        CDSnapshotCatalog.invalidate(self)
 
+    @on_primary
     def copyTag(self, tag, new_tag, comment="", override=False):
 
         if override:
@@ -1464,4 +2682,5 @@ create index %T_update_inx on %t_update (__snapshot_id, __tv, __channel);
                         where s.__tag_name = %s);
             """, (new_tag, comment, new_tag, tag))
         self.execute("commit", ())
+        CDSnapshotCatalog.invalidate(self)
                                   
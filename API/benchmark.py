@@ -0,0 +1,82 @@
+#
+# Benchmarks for the in-memory snapshot algorithms of CDTable.
+# Uses synthetic snapshots, does not need a database.
+#
+
+import sys, getopt, random, time
+from datetime import datetime, timedelta
+from timelib import UTC
+from ConDB import CDSnapshot, CDTable
+
+Usage = """
+python benchmark.py [options] <n>[,<n>...]
+options:
+    -m <n>          run original O(n^2) versions only up to this number of snapshots, default = 3000
+    -p <fraction>   fraction of snapshots with tv_end (patches), default = 0.3
+                    -p 0 gives tr-ordered snapshots where none is shadowed, the worst case
+                    for the original purgeShadowedSnapshots
+    -s <seed>       random seed, default = 0
+"""
+
+def synthetic_snapshots(n, patch_fraction, rnd):
+    # returns [snapshot,...] ordered by tr
+    # regular snapshots are created about one hour of tv apart, in the order of tv,
+    # patches go back to a random time in the past and are up to a day long
+    t0 = datetime(2020, 1, 1, tzinfo=UTC())
+    hour = 3600
+    lst = []
+    for i in range(n):
+        tr = t0 + timedelta(seconds=(n + i)*hour)
+        if rnd.random() < patch_fraction:
+            tv = t0 + timedelta(seconds=rnd.uniform(0, i*hour))
+            s = CDSnapshot(None, i+1, tv = tv, tr = tr)
+            s.Tv_end = tv + timedelta(seconds=rnd.uniform(60, 24*hour))
+        else:
+            tv = t0 + timedelta(seconds=(i + rnd.uniform(-0.5, 0.5))*hour)
+            s = CDSnapshot(None, i+1, tv = tv, tr = tr)
+        s.InfoFetched = True
+        lst.append(s)
+    return lst
+
+def timed(f, *params):
+    t0 = time.time()
+    result = f(*params)
+    return time.time() - t0, result
+
+def segment_key(sg):
+    return (sg.Snapshot.Id, sg.Tv, sg.Tend)
+
+def bench_overlay(table, snapshots, run_original):
+    t_new, new = timed(table.overlaySnapshots, snapshots)
+    print("overlaySnapshots:          n=%-7d segments=%-7d %.3f sec" % (len(snapshots), len(new), t_new))
+    if run_original:
+        t_old, old = timed(table.overlaySnapshots_, snapshots)
+        same = [segment_key(sg) for sg in old] == [segment_key(sg) for sg in new]
+        print("overlaySnapshots_ (orig):  n=%-7d segments=%-7d %.3f sec  same result: %s" %
+                (len(snapshots), len(old), t_old, same))
+
+def bench_purge(table, snapshots, run_original):
+    t_new, new = timed(table.purgeShadowedSnapshots, snapshots)
+    print("purgeShadowedSnapshots:          n=%-7d kept=%-7d %.3f sec" % (len(snapshots), len(new), t_new))
+    if run_original:
+        t_old, old = timed(table.purgeShadowedSnapshots_, snapshots)
+        same = [s.Id for s in old] == [s.Id for s in new]
+        print("purgeShadowedSnapshots_ (orig):  n=%-7d kept=%-7d %.3f sec  same result: %s" %
+                (len(snapshots), len(old), t_old, same))
+
+if __name__ == "__main__":
+    opts, args = getopt.getopt(sys.argv[1:], 'm:p:s:')
+    opts = dict(opts)
+    if not args:
+        print(Usage)
+        sys.exit(1)
+
+    max_original = int(opts.get("-m", 3000))
+    patch_fraction = float(opts.get("-p", 0.3))
+    rnd = random.Random(int(opts.get("-s", 0)))
+    table = CDTable(None, "benchmark", [])
+
+    for n in [int(x) for x in args[0].split(",")]:
+        snapshots = synthetic_snapshots(n, patch_fraction, rnd)
+        bench_overlay(table, snapshots, n <= max_original)
+        bench_purge(table, snapshots, n <= max_original)
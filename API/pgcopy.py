@@ -0,0 +1,243 @@
+#
+# COPY ... FROM STDIN data streams for psycopg2 cursor.copy_expert()
+#
+# PGCopyWriter encodes rows in the binary COPY format, using the SQL types of the columns.
+# text_copy_chunks() encodes rows in the text format, with escaping, for column types
+# without binary encoder.
+# CopyStream turns an iterator of encoded chunks into the file-like object copy_expert()
+# reads from, so rows are encoded as COPY consumes them, without building the whole
+# data in memory.
+#
+
+import struct, datetime, re, itertools
+from timelib import text2datetime
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+PGCopyHeader = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCopyTrailer = struct.pack("!h", -1)
+PGNull = struct.pack("!i", -1)
+PGEpochDate = datetime.date(2000, 1, 1).toordinal()
+
+_length = struct.Struct("!i")
+_int2 = struct.Struct("!ih")
+_int4 = struct.Struct("!ii")
+_int8 = struct.Struct("!iq")
+_float4 = struct.Struct("!if")
+_float8 = struct.Struct("!id")
+_bool = struct.Struct("!i?")
+
+def encode_bool(x):
+    if isinstance(x, str):
+        x = x.strip().lower() in ("t", "true", "y", "yes", "on", "1")
+    return _bool.pack(1, bool(x))
+
+def integer(x):
+    # int() would truncate floats, the text format would reject them
+    i = int(x)
+    if isinstance(x, float) and i != x:
+        raise ValueError("Non-integral value %r for an integer column" % (x,))
+    return i
+
+def encode_text(x):
+    b = (x if isinstance(x, str) else str(x)).encode("utf-8")
+    return _length.pack(len(b)) + b
+
+PGEpoch = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+PGEpochNaive = datetime.datetime(2000, 1, 1)
+Microsecond = datetime.timedelta(microseconds=1)
+
+def timestamp_encoder(tz):
+    # tz: tzinfo used for naive datetimes with "timestamp with time zone", None for "timestamp"
+    # text values are parsed with text2datetime()
+    if tz is None:
+        def encode(x):
+            # wall clock time, the time zone is dropped as with text input
+            if isinstance(x, str):  x = text2datetime(x)
+            return _int8.pack(8, (x.replace(tzinfo=None) - PGEpochNaive) // Microsecond)
+    else:
+        def encode(x):
+            if isinstance(x, str):  x = text2datetime(x)
+            if x.tzinfo is None:
+                x = x.replace(tzinfo=tz)
+            return _int8.pack(8, (x - PGEpoch) // Microsecond)
+    return encode
+
+def encode_date(x):
+    return _int4.pack(4, x.toordinal() - PGEpochDate)
+
+ScalarTypes = {
+    # SQL type: (oid, encoder)
+    "smallint":             (21, lambda x: _int2.pack(2, integer(x))),
+    "integer":              (23, lambda x: _int4.pack(4, integer(x))),
+    "bigint":               (20, lambda x: _int8.pack(8, integer(x))),
+    "real":                 (700, lambda x: _float4.pack(4, float(x))),
+    "double precision":     (701, lambda x: _float8.pack(8, float(x))),
+    "boolean":              (16, encode_bool),
+    "text":                 (25, encode_text),
+    "character varying":    (1043, encode_text),
+    "date":                 (1082, encode_date),
+    "timestamp without time zone":  (1114, None),
+    "timestamp with time zone":     (1184, None),
+}
+
+def array_encoder(oid, encode_element):
+    def dimensions(x):
+        dims = []
+        while isinstance(x, (list, tuple)):
+            dims.append(len(x))
+            if not x:   break
+            x = x[0]
+        return dims
+
+    def flatten(x, depth):
+        if depth == 0:
+            yield x
+        else:
+            for y in x:
+                for z in flatten(y, depth-1):
+                    yield z
+
+    def encode(x):
+        dims = dimensions(x)
+        if 0 in dims:
+            # empty array
+            payload = struct.pack("!iii", 0, 0, oid)
+        else:
+            parts = []
+            has_null = 0
+            for e in flatten(x, len(dims)):
+                if e is None:
+                    has_null = 1
+                    parts.append(PGNull)
+                else:
+                    parts.append(encode_element(e))
+            header = struct.pack("!iii", len(dims), has_null, oid) + \
+                b"".join([struct.pack("!ii", n, 1) for n in dims])
+            payload = header + b"".join(parts)
+        return _length.pack(len(payload)) + payload
+    return encode
+
+TypeModifier = re.compile(r"\(.*\)")
+
+def binary_encoder(sql_type, tz=None):
+    # returns encoder function for the SQL type as returned by format_type(), or None if not supported
+    # tz: tzinfo used for naive datetimes in "timestamp with time zone" columns. If it is not known,
+    #   the column is not supported: the text format lets the DB interpret naive times in the session time zone
+    array = sql_type.endswith("[]")
+    base = TypeModifier.sub("", sql_type.rstrip("[]")).strip()
+    if base not in ScalarTypes:
+        return None
+    oid, encode = ScalarTypes[base]
+    if base == "timestamp with time zone":
+        if tz is None:
+            return None
+        encode = timestamp_encoder(tz)
+    elif base == "timestamp without time zone":
+        encode = timestamp_encoder(None)
+    if array:
+        encode = array_encoder(oid, encode)
+    return encode
+
+UTCNames = ("UTC", "Etc/UTC", "GMT", "Etc/GMT")
+
+def session_timezone(conn):
+    # returns tzinfo of the TimeZone setting of the psycopg2 connection, or None if it is not known
+    name = conn.get_parameter_status("TimeZone")
+    if name in UTCNames:
+        return datetime.timezone.utc
+    if not name or zoneinfo is None:
+        return None
+    try:    return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return None
+
+class PGCopyWriter:
+
+    BatchSize = 1000        # rows per chunk
+
+    def __init__(self, encoders):
+        self.Encoders = encoders
+        self.FieldCount = struct.pack("!h", len(encoders))
+
+    @staticmethod
+    def forTypes(sql_types, tz=None):
+        # returns PGCopyWriter for the column types, or None if some type has no binary encoder
+        encoders = [binary_encoder(t, tz) for t in sql_types]
+        if None in encoders:
+            return None
+        return PGCopyWriter(encoders)
+
+    def encodeRow(self, row):
+        return self.FieldCount + b"".join([PGNull if x is None else encode(x)
+                                            for encode, x in zip(self.Encoders, row)])
+
+    def chunks(self, rows):
+        # rows: iterator [(value, ...),...]
+        # returns iterator of bytes, the binary COPY data
+        yield PGCopyHeader
+        rows = iter(rows)
+        encode = self.encodeRow
+        batch = list(itertools.islice(rows, self.BatchSize))
+        while batch:
+            yield b"".join([encode(row) for row in batch])
+            batch = list(itertools.islice(rows, self.BatchSize))
+        yield PGCopyTrailer
+
+TextEscapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def text_array_literal(x):
+    items = []
+    for e in x:
+        if e is None:
+            items.append("NULL")
+        elif isinstance(e, (list, tuple)):
+            items.append(text_array_literal(e))
+        else:
+            e = str(e)
+            if e == "" or e.upper() == "NULL" or any(c in e for c in '{},"\\ \t\n'):
+                e = '"' + e.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            items.append(e)
+    return "{" + ",".join(items) + "}"
+
+def text_copy_value(x):
+    if x is None:
+        return "\\N"
+    if isinstance(x, (list, tuple)):
+        x = text_array_literal(x)
+    return str(x).translate(TextEscapes)
+
+def text_copy_chunks(rows, batch_size=1000):
+    # rows: iterator [(value, ...),...]
+    # returns iterator of bytes, the text COPY data
+    rows = iter(rows)
+    batch = list(itertools.islice(rows, batch_size))
+    while batch:
+        yield "".join(["\t".join([text_copy_value(x) for x in row]) + "\n" for row in batch]).encode("utf-8")
+        batch = list(itertools.islice(rows, batch_size))
+
+class CopyStream:
+    # file-like object for cursor.copy_expert(), reads from an iterator of bytes chunks
+
+    def __init__(self, chunks):
+        self.Chunks = iter(chunks)
+        self.Buffer = b""
+
+    def read(self, size=-1):
+        parts = [self.Buffer]
+        n = len(self.Buffer)
+        while size < 0 or n < size:
+            try:    chunk = next(self.Chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            n += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            self.Buffer = b""
+            return data
+        self.Buffer = data[size:]
+        return data[:size]
@@ -18,6 +18,11 @@ class TracePoint:
         self.Count += 1
         self.Time += time.time() - self.T0
         return self
+
+    def count(self, n=1):
+        # counter only, no timing
+        self.Count += n
+        return self
         
     def stats(self):
         avg = None
@@ -50,6 +55,9 @@ class Tracer:
         
     def end(self, name):
         return self[name].end()
+
+    def count(self, name, n=1):
+        return self[name].count(n)
     
     def stats(self):
         return [(n, p.stats()) for n, p in self.Points.items()]
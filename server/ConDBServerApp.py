@@ -1,21 +1,26 @@
 from webpie import WPApp, WPHandler, Response
 from wsdbtools import ConnectionPool
 from configparser import ConfigParser
-from ConDB import ConDB
+from ConDB import ConDB, CDSnapshotCatalog, CDConnectionPool, CDReplica
 import time, sys, hashlib, os, random, traceback
 from datetime import datetime, timedelta, tzinfo
-from timelib import text2datetime, epoch
+from timelib import text2datetime, text2datetime_fast, epoch, UTC
 from threading import RLock, Lock, Condition
-import threading, re
+import threading, re, json, tempfile, shutil
 from trace import Tracer
 
 from py3 import to_bytes, to_str
-from signature import signature
+from signature import signature, signature_digest
 
 from GUI_Version import GUI_Version
 from API_Version import API_Version
 from DataBrowser import DataBrowser
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 class   ConfigFile(ConfigParser):
     def __init__(self, path=None, envVar=None):
         ConfigParser.__init__(self)
@@ -40,12 +45,47 @@ def format_tv(x, numeric):
     if numeric: return as_number(x)
     else:   return dtfmt(x, "%Y-%m-%d&nbsp;%H:%M:%S&nbsp;%Z")
         
+def number_or_text(word):
+    try:    return int(word)
+    except ValueError:
+        try:    return float(word)
+        except ValueError:
+            return word       # text
+
+def csv_value(word):
+    # converts unquoted CSV field the same way as ConDBHandler.parseTuple()
+    word = word.strip()
+    if not word:    return None
+    if word[0] == '[':
+        assert word[-1] == ']'
+        # assume this is list of numbers. List of strings is not supported !
+        return [number_or_text(w.strip()) for w in word[1:-1].split(",")]
+    return number_or_text(word)
+
+MsgpackContentTypes = ("application/x-msgpack", "application/msgpack", "application/vnd.msgpack")
+
 def nones_to_nulls(x):
     if type(x) == type([]) or type(x) == type(()):
         return [z if z != None else "null" for z in x ]
     elif x == None: return "null"
     else:   return x
 
+class ClosingBody:
+    # WSGI response body calling on_close() when the server closes it after sending the response
+
+    def __init__(self, body, on_close):
+        self.Body = body
+        self.OnClose = on_close
+
+    def __iter__(self):
+        return iter(self.Body)
+
+    def close(self):
+        try:
+            if hasattr(self.Body, "close"):
+                self.Body.close()
+        finally:
+            self.OnClose()
            
 class ConDBServerApp(WPApp):
 
@@ -63,6 +103,40 @@ class ConDBServerApp(WPApp):
             self.TaggedCacheTTL = int(self.Config.get('Server', 'TaggedCacheTTL'))
         except:
             self.TaggedCacheTTL = 3600*24*7   # 7 days
+        try:
+            self.SingleQueryReads = self.Config.get('Server', 'SingleQueryReads') == "yes"
+        except:
+            self.SingleQueryReads = False
+        try:
+            self.SnapshotCatalog = self.Config.get('Server', 'SnapshotCatalog') == "yes"
+        except:
+            self.SnapshotCatalog = False
+        try:
+            self.IterSize = int(self.Config.get('Server', 'IterSize'))
+        except:
+            self.IterSize = None
+        try:
+            # yes - point lookups only, all - bulk reads too, which then are not streamed
+            self.PreparedStatements = {"yes": True, "all": "all"}.get(
+                self.Config.get('Server', 'PreparedStatements'), False)
+        except:
+            self.PreparedStatements = False
+        try:
+            CDSnapshotCatalog.RefreshInterval = float(self.Config.get('Server', 'CatalogRefreshInterval'))
+        except:
+            pass
+        try:
+            # rows per addData call for /put uploads, 0 = whole upload at once.
+            # Uploads longer than this must be ordered by tv for each channel, otherwise a later chunk
+            # shadows the updates added by an earlier one
+            self.PutChunkRows = int(self.Config.get('Server', 'PutChunkRows'))
+        except:
+            self.PutChunkRows = 0
+        try:
+            # uploads larger than this are spooled to a temporary file
+            self.PutSpoolSize = int(self.Config.get('Server', 'PutSpoolSize'))
+        except:
+            self.PutSpoolSize = 10*1024*1024
        
         #
         # Init DB connection pool 
@@ -95,6 +169,35 @@ class ConDBServerApp(WPApp):
         if self.Port:   connstr += " port=%s" % (self.Port,)
         if self.Host:   connstr += " host=%s" % (self.Host,)
         self.ConnPool = ConnectionPool(postgres=connstr, idle_timeout=5)
+
+        #
+        # Read replicas: replicas = <connstr>; <connstr>; ...
+        #
+        self.Replicas = []
+        try:
+            replicas = [x.strip() for x in cfg.get('Database', 'replicas').split(';')]
+        except:
+            replicas = []
+        try:
+            replica_pool_size = int(cfg.get('Database', 'replica_pool_size'))
+        except:
+            replica_pool_size = 20
+        try:
+            # seconds to wait for a free replica connection
+            replica_timeout = float(cfg.get('Database', 'replica_timeout'))
+        except:
+            replica_timeout = 10.0
+        self.Replicas = [CDReplica(CDConnectionPool(r, min_size=0, max_size=replica_pool_size, 
+                                        timeout=replica_timeout))
+                            for r in replicas if r]
+        try:
+            self.ReplicaRouting = cfg.get('Database', 'replica_routing')
+        except:
+            self.ReplicaRouting = "round_robin"
+        try:
+            self.ReadYourWrites = float(cfg.get('Database', 'read_your_writes'))
+        except:
+            self.ReadYourWrites = None
         
         self.initJinjaEnvironment(
             tempdirs=[os.environ["JINJA_TEMPLATES_LOCATION"]],
@@ -112,10 +215,28 @@ class ConDBServerApp(WPApp):
             }
         )
             
+    def __call__(self, environ, start_response):
+        # replica connections are checked out by the thread for the request, and returned to
+        # their pools after the response body, which may be streamed from the DB, was sent
+        try:
+            body = WPApp.__call__(self, environ, start_response)
+        except:
+            self.releaseConnections()
+            raise
+        return ClosingBody(body, self.releaseConnections)
+
+    def releaseConnections(self):
+        # rolls back and returns the replica connections checked out by the current thread
+        for replica in self.Replicas:
+            replica.disconnect()
+
     def db(self):
         conn = self.ConnPool.connect()
         #print("App.db(): connection:", id(conn), conn)
-        return ConDB(connection = conn)
+        return ConDB(connection = conn, snapshot_catalog = self.SnapshotCatalog,
+                    itersize = self.IterSize, prepare = self.PreparedStatements,
+                    replicas = self.Replicas, routing = self.ReplicaRouting,
+                    read_your_writes = self.ReadYourWrites)
         
 
 class ConDBHandler(WPHandler):
@@ -252,6 +373,8 @@ class ConDBHandler(WPHandler):
                 
             conds = []
             for c, op, value in conditions:
+                if c not in coldict:
+                    raise ValueError("Unknown column in condition: %s" % (c,))
                 conds.append((coldict[c], op, value))            
             
             data.sort(lambda x,y: cmp(x[0], y[0]) or cmp(x[1], y[1]))    # sort by channel then tv
@@ -309,6 +432,29 @@ class ConDBHandler(WPHandler):
             
         return data
             
+    def parseChannels(self, channels):
+        # channels: "c0-c1,c,c0-,-c1,..."
+        # returns [channel or (c0, c1),...] or None
+        channel_ranges = []
+        
+        if channels:
+            for segment in channels.split(","):
+                c01 = segment.split("-", 1)
+                if len(c01) < 2:
+                    c01 = [c01[0], c01[0]]
+                c0, c1 = c01
+                c0 = c0 or None                 # convert blanks to None
+                c1 = c1 or None
+                try:    c0 = int(c0)
+                except: pass                    # either None or string
+                try:    c1 = int(c1)
+                except: pass                    # either None or string
+                if (c0, c1) != (None, None):
+                    # single channels go to the DB as a list, ranges as OR'ed conditions
+                    channel_ranges.append(c0 if c0 == c1 else (c0, c1))
+
+        return channel_ranges or None
+
     def getData(self, table, t=None, t0=None, t1=None, 
                     cr=None, 
                     channels=None,
@@ -329,35 +475,11 @@ class ConDBHandler(WPHandler):
         if data_type:   data_type = str(data_type)
 
         if channels is None:    channels = cr
-        
-        channel_ranges = []
-        cmin, cmax = None, None
-        
-        if channels:
-            for segment in channels.split(","):
-                c01 = segment.split("-", 1)
-                if len(c01) < 2:
-                    c01 = [c01[0], c01[0]]
-                c0, c1 = c01
-                c0 = c0 or None                 # convert blanks to None
-                c1 = c1 or None
-                try:    c0 = int(c0)
-                except: pass                    # either None or string
-                try:    c1 = int(c1)
-                except: pass                    # either None or string
-                if (c0, c1) != (None, None):
-                    channel_ranges.append((c0, c1))
-                    if cmin is None:    cmin = c0
-                    if cmax is None:    cmax = c1
-                    if c0 is not None:  cmin = min(cmin, c0)
-                    if c1 is not None:  cmax = max(cmax, c1)
-
-        channel_ranges = channel_ranges or None
-        global_range = (cmin, cmax) if (cmin or cmax) else None
+        channel_ranges = self.parseChannels(channels)
 
         if t != None:
             lines = self.getAtTime(table, t, data_type=data_type, tag = tag,
-                            rtime=rtime, channel_range = global_range,
+                            rtime=rtime, channels = channel_ranges,
                             conditions = conditions)
         else:
             #print "calling getInterval..."
@@ -365,12 +487,12 @@ class ConDBHandler(WPHandler):
             if iter == "yes" and not sort:
                 lines = self.getIntervalIter(table, t0, t1, data_type=data_type, 
                                 tag = tag,
-                                rtime=rtime, channel_range = global_range,
+                                rtime=rtime, channels = channel_ranges,
                                 conditions = conditions)
             else:
                 lines = self.getInterval(table, t0, t1, data_type=data_type, 
                                 tag = tag,
-                                rtime=rtime, channel_range = global_range,
+                                rtime=rtime, channels = channel_ranges,
                                 conditions = conditions, sort = sort)
 
         #lines = list(lines)
@@ -378,7 +500,7 @@ class ConDBHandler(WPHandler):
 
         #print "channel ranges:", channel_ranges
 
-        lines = self.filterAndSort(table, lines, conditions, sort, channel_ranges)
+        lines = self.filterAndSort(table, lines, conditions, sort, None)
 
         return lines
 
@@ -393,26 +515,35 @@ class ConDBHandler(WPHandler):
         #print "get(%s,%s,%s)" % (table, t0, t1)
 
 
-        columns = columns.split(',')
+        # columns are optional, default: all columns of the table
         table_name = table
-        table = self.App.db().table(table, columns)
-        if not table.exists():
+        if columns:
+            table = self.App.db().table(table, columns.split(','))
+            if not table.exists():
+                table = None
+        else:
+            table = self.App.db().tableFromDB(table)
+        if table is None:
             return Response("Table %s does not exist" % (table_name,), status=404)
             
         
-        lines = self.getData(table, **args)
+        # the data are read as the lines are joined, conditions are checked then
+        try:
+            lines = self.getData(table, **args)
                     
-        if lines == None:
-            lines = []
+            if lines == None:
+                lines = []
 
-        #lines = list(lines)
-        #print "get: len(lines)=%d" % (len(lines),)
+            #lines = list(lines)
+            #print "get: len(lines)=%d" % (len(lines),)
 
-        lines = self.csv_iterator_from_iter(table, lines)
+            lines = self.csv_iterator_from_iter(table, lines)
 
-        #resp = Response(content_type='text/plain', 
-        #    app_iter = self.mergeLines(lines))
-        out = ''.join(lines)
+            #resp = Response(content_type='text/plain', 
+            #    app_iter = self.mergeLines(lines))
+            out = ''.join(lines)
+        except ValueError as e:     # unknown column or operator in "where", rtime with tag
+            return Response("Invalid request: %s" % (e,), status=400)
         #print "get: output length=", len(out)
         resp = Response(out, content_type='text/plain')
         cache_ttl = self.App.CacheTTL
@@ -422,9 +553,138 @@ class ConDBHandler(WPHandler):
         resp.cache_expires(cache_ttl)
         return resp
 
+    def diff(self, req, relpath, table=None, columns=None, 
+                    t1=None, tag1=None, rtime1=None, type1=None,
+                    t2=None, tag2=None, rtime2=None, type2=None,
+                    channels=None, cr=None, **args):
+        # returns CSV: channel,tv1,<columns>,tv2,<columns>
+        # for channels with different data at (t1, tag1, rtime1, type1) and (t2, tag2, rtime2, type2).
+        # Fields of a missing side are left blank
+        table_name = table
+        if columns:
+            table = self.App.db().table(table, columns.split(','))
+            if not table.exists():
+                table = None
+        else:
+            table = self.App.db().tableFromDB(table)
+        if table is None:
+            return Response("Table %s does not exist" % (table_name,), status=404)
+
+        def spec(t, tag, rtime, data_type):
+            t = text2datetime(t)
+            rtime = text2datetime(rtime) if rtime and not tag else None
+            return (t, tag or None, rtime, data_type or None)
+
+        if channels is None:    channels = cr
+        diffs = table.diff(spec(t1, tag1, rtime1, type1), spec(t2, tag2, rtime2, type2), 
+                    channels = self.parseChannels(channels), 
+                    conditions = self.parseConditions(args))
+        blank = ','.join([''] * (len(table.columns()) + 1))
+
+        def side(tup):
+            if tup is None: return blank
+            return '%.3f,%s' % (epoch(tup[0]), self.dataTupleToCSV(tup[1:]))
+
+        def lines():
+            yield 'channel,tv1,%s,tv2,%s\n' % (','.join(table.columns()), ','.join(table.columns()))
+            for channel, a, b in diffs:
+                yield '%d,%s,%s\n' % (channel, side(a), side(b))
+
+        try:
+            out = ''.join(lines())
+        except ValueError as e:     # unknown column or operator in "where"
+            return Response("Invalid request: %s" % (e,), status=400)
+        return Response(out, content_type='text/plain')
+
+    def history(self, req, relpath, table=None, channel=None, t0=None, t1=None, 
+                    limit="1000", after=None, tag=None, rtime=None, columns=None, **args):
+        # returns CSV: tv,<columns>, one page of the channel history ordered by tv.
+        # If there are more pages, the X-Continuation-Token response header has the value
+        # to pass as "after" to get the next page
+        table_name = table
+        if columns:
+            table = self.App.db().table(table, columns.split(','))
+            if not table.exists():
+                table = None
+        else:
+            table = self.App.db().tableFromDB(table)
+        if table is None:
+            return Response("Table %s does not exist" % (table_name,), status=404)
+        if channel is None:
+            return Response("Channel must be specified", status=400)
+
+        data_type = args.get('type') or None
+        t0 = text2datetime(t0)
+        t1 = text2datetime(t1)
+        rtime = text2datetime(rtime) if rtime and not tag else None
+        try:
+            rows, token = table.channelHistory(int(channel), t0, t1, limit=int(limit), after=after,
+                    tag=tag, tr=rtime, data_type=data_type)
+        except ValueError as e:     # invalid channel, limit or continuation token
+            return Response("Invalid request: %s" % (e,), status=400)
+        lines = ['tv,' + ','.join(table.columns()) + '\n']
+        for tup in rows:
+            lines.append('%.3f,%s\n' % (epoch(tup[0]), self.dataTupleToCSV(tup[1:])))
+        resp = Response(''.join(lines), content_type='text/plain')
+        if token:
+            resp.headers['X-Continuation-Token'] = token
+        return resp
+
+    def changes(self, req, relpath, table=None, since=None, channels=None, cr=None, columns=None, 
+                    limit="10000", after=None, **args):
+        # returns JSON: snapshots and updates recorded after "since", and the new watermark.
+        # "since" is the watermark returned by the previous call, or a time.
+        # If there were more than limit updates, "next" is not null: pass it as "after" 
+        # with the same "since" to get the next page
+        table_name = table
+        if columns:
+            table = self.App.db().table(table, columns.split(','))
+            if not table.exists():
+                table = None
+        else:
+            table = self.App.db().tableFromDB(table)
+        if table is None:
+            return Response("Table %s does not exist" % (table_name,), status=404)
+        if not since:
+            return Response("Watermark (since) must be specified", status=400)
+        try:    since = datetime.fromisoformat(since)
+        except ValueError:
+            since = text2datetime(since)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=UTC())
+        if channels is None:    channels = cr
+
+        try:
+            snapshots, updates, watermark, token = table.changesSince(since, channels=self.parseChannels(channels),
+                        limit=int(limit), after=after)
+        except ValueError as e:     # invalid limit or continuation token
+            return Response("Invalid request: %s" % (e,), status=400)
+        out = {
+            "watermark":    watermark.isoformat(),
+            "next":         token,
+            "columns":      table.columns(),
+            "snapshots":    [
+                {   "id":       s.Id,   
+                    "tv":       epoch(s.Tv),    
+                    "tv_end":   epoch(s.Tv_end) if s.Tv_end is not None else None,
+                    "tr":       epoch(s.Tr),
+                    "type":     s.DataType
+                } for s in snapshots 
+            ],
+            "updates":      [
+                {   "snapshot_id":  tup[0],
+                    "channel":      tup[1],
+                    "tv":           epoch(tup[2]),
+                    "tr":           epoch(tup[3]),
+                    "values":       list(tup[4:])
+                } for tup in updates
+            ]
+        }
+        return Response(json.dumps(out), content_type="text/json")
+
     def getAtTime(self, table, t, tag=None, rtime=None, data_type=None, 
                     conditions = [],
-                    channel_range = None, **args):
+                    channel_range = None, channels = None, **args):
         # returns iterator [(channel, tv, (data,...)),...]
         t = text2datetime(t)
         if not tag and rtime:    
@@ -433,16 +693,17 @@ class ConDBHandler(WPHandler):
             rtime =  None
         
         data = table.getDataIter(t, tag=tag, tr=rtime, data_type=data_type,
-                    channel_range = channel_range, conditions = conditions)
+                    channel_range = channel_range, conditions = conditions,
+                    single_query = self.App.SingleQueryReads, channels = channels)
         return ((tup[0], tup[1], tup[2:]) for tup in data)
 
     def getIntervalIter(self, table, t0, t1, tag=None, rtime=None, data_type=None, 
-                        channel_range = None, conditions = [], **args):
+                        channel_range = None, conditions = [], channels = None, **args):
         t0 = text2datetime(t0)
         t1 = text2datetime(t1)
         if not tag and rtime:    rtime = text2datetime(rtime)
         data = table.getDataIntervalIter(t0, t1, tag=tag, tr=rtime, data_type=data_type,
-                        channel_range = channel_range, conditions = conditions)
+                        channel_range = channel_range, conditions = conditions, channels = channels)
         return data
         
     def getInterval(self, table, t0, t1, sort=None, **args):
@@ -451,10 +712,20 @@ class ConDBHandler(WPHandler):
             out = self.sortTuples(out, sort)
         return out
 
+    def parseLine(self, line):
+        # same as parseTuple(), which is used only for lines with quoted values
+        if '"' in line:
+            return self.parseTuple(line)
+        words = line.split(',')
+        if len(words) > 1 and not words[-1].strip():
+            words.pop()         # trailing comma
+        return tuple(csv_value(w) for w in words)
+
     def parseTuple(self, line):
         out = []
         while line:
             line = line.strip()
+            if not line:    break
             if line[0] == '"':
                 # find closing quote
                 i = 1
@@ -485,7 +756,7 @@ class ConDBHandler(WPHandler):
             
             value = None
             
-            if word[0] == '"':
+            if word and word[0] == '"':
                 assert word[-1] == '"'
                 word = word[1:-1].replace('""', '"')
             
@@ -517,12 +788,37 @@ class ConDBHandler(WPHandler):
         return tuple(out)   
 
 
+    ReadBlockSize = 1024*1024
+
     def authenticateSignature(self, req, data):
+        # data: bytes or binary file, which is read to the end and rewound
         salt = req.headers['X-Salt']
         sig = req.headers['X-Signature']
         table = req.GET['table']
-        digest = signature(self.App.ServerPassword, salt, req.query_string, data)
+        if hasattr(data, "read"):
+            m = signature_digest(self.App.ServerPassword, salt, req.query_string)
+            for block in iter(lambda: data.read(self.ReadBlockSize), b""):
+                m.update(block)
+            data.seek(0)
+            digest = m.hexdigest()
+        else:
+            digest = signature(self.App.ServerPassword, salt, req.query_string, data)
         return digest == sig
+
+    def spoolBody(self, req):
+        # returns the request body as a binary file, read in blocks, in memory or in a temporary file
+        # if larger than PutSpoolSize
+        body = tempfile.SpooledTemporaryFile(max_size=self.App.PutSpoolSize)
+        shutil.copyfileobj(req.body_file, body, self.ReadBlockSize)
+        body.seek(0)
+        return body
+
+    def addUploadedData(self, table, data, tolerances, types):
+        if not types:
+            table.addData(data, tolerances)
+        else:
+            for t in types:
+                table.addData(data, tolerances, data_type=t)
         
     def put(self, req, relpath, table=None, **args):
         if req.method != 'POST':
@@ -530,8 +826,9 @@ class ConDBHandler(WPHandler):
             resp.status = 400
             return resp
 
+        body = self.spoolBody(req)
         if "X-Signature" in req.headers:
-            check = self.authenticateSignature(req, req.body)
+            check = self.authenticateSignature(req, body)
             if not check:
                 resp = Response("Signature forged")
                 resp.status = 400
@@ -541,10 +838,23 @@ class ConDBHandler(WPHandler):
             resp.status = 400
             return resp
         
-        input = to_str(req.body).split("\n")
+        types = []
+        for t in req.GET.getall('type'):
+            for x in t.split(','):
+                x = x.strip()
+                if not x in types:
+                    types.append(x)
+
+        #print "types=", types
+
+        if req.content_type in MsgpackContentTypes:
+            return self.putMsgpack(body, table, types)
+
+        # the body is parsed as it is read, data go to the DB in chunks of PutChunkRows rows, if configured.
+        # SpooledTemporaryFile can not be wrapped in TextIOWrapper before Python 3.11, lines are decoded one by one
+        input = (line.decode("utf-8", errors="ignore") for line in body)
         tolerances = None
-        header = input[0].strip()
-        columns = [x.strip() for x in header.split(',')]
+        columns = [x.strip() for x in next(input, "").split(',')]
         if len(columns) < 3 or \
                 columns[0].lower() != 'channel' or \
                 columns[1].lower() != 'tv':
@@ -554,46 +864,82 @@ class ConDBHandler(WPHandler):
                 
         columns = columns[2:]
         #print 'columns: ', columns
+
         table = self.App.db().table(table, columns)
+        chunk_rows = self.App.PutChunkRows
         data = []
-        for i in range(1, len(input)):
-            line = input[i].strip()
+        nrows = 0
+        for line in input:
+            line = line.strip()
             if not line:    continue
-            #print("line:", line)
             if line.startswith('tolerance,,'):
-                tolerances = self.parseTuple(line[len('tolerance,,'):])
+                tolerances = self.parseLine(line[len('tolerance,,'):])
                 continue
-
-            tup = self.parseTuple(line)
-            channelid = tup[0]
-            tv = text2datetime(tup[1])
-            #print tv
-            values = tup[2:]
-            #print "data: ", channelid, tv, values
-            data.append((channelid, tv, values))
+            tup = self.parseLine(line)
+            data.append((tup[0], text2datetime_fast(tup[1]), tup[2:]))
+            if chunk_rows and len(data) >= chunk_rows:
+                self.addUploadedData(table, data, tolerances, types)
+                nrows += len(data)
+                data = []
             
-        if not data:
-            return Response("OK", status=204)
-
-        #print "len(data)=", len(data)
+        if data:
+            self.addUploadedData(table, data, tolerances, types)
+            nrows += len(data)
 
-        types = []
-        for t in req.GET.getall('type'):
-            for x in t.split(','):
-                x = x.strip()
-                if not x in types:
-                    types.append(x)
+        if not nrows:
+            return Response("OK", status=204)
+        return Response("OK")
 
-        #print "types=", types
+    def putMsgpack(self, body, table, types):
+        #
+        # body: msgpack map with the data arranged by column:
+        #   {
+        #       "columns":      [column, ...],
+        #       "channel":      [channel, ...],
+        #       "tv":           [tv, ...],                  # msgpack timestamps, epoch numbers or text
+        #       "data":         [[value, ...], ...],        # one array per column, in the order of "columns"
+        #       "tolerances":   [tolerance, ...]            # optional
+        #   }
+        # the arrays are decoded by msgpack and zipped into rows without converting values one by one.
+        # tv values other than timestamps are converted the same way as in CSV input
+        #
+        if msgpack is None:
+            return Response("msgpack input is not supported by this server", status=415)
+        try:    
+            input = msgpack.unpack(body, raw=False, timestamp=3)
+        except Exception as e:
+            return Response("Invalid msgpack input: %s" % (e,), status=400)
+        if not isinstance(input, dict):
+            return Response("Invalid msgpack input: expected a map", status=400)
+        columns = input.get("columns")
+        channels = input.get("channel")
+        tvs = input.get("tv")
+        arrays = input.get("data")
+        tolerances = input.get("tolerances")
+        if not isinstance(columns, list) or not columns or not all(isinstance(c, str) for c in columns):
+            return Response("Invalid msgpack input: columns must be a non-empty array of names", status=400)
+        if not isinstance(arrays, list) or len(arrays) != len(columns) or \
+                not all(isinstance(a, list) for a in [channels, tvs] + arrays) or \
+                any(len(a) != len(channels) for a in [tvs] + arrays):
+            return Response("Invalid msgpack input: channel, tv and data must be arrays of the same length", 
+                        status=400)
+        if not set(map(type, channels)) <= {int}:
+            return Response("Invalid msgpack input: channels must be integers", status=400)
+        if tolerances is not None:
+            if not isinstance(tolerances, list):
+                return Response("Invalid msgpack input: tolerances must be an array", status=400)
+            tolerances = tuple(tolerances)
+        if not channels:
+            return Response("OK", status=204)
+        if not all(isinstance(t, datetime) for t in tvs):
+            try:    tvs = [t if isinstance(t, datetime) else text2datetime_fast(t) for t in tvs]
+            except (TypeError, ValueError) as e:
+                return Response("Invalid msgpack input: invalid tv: %s" % (e,), status=400)
 
-        if not types:
-            #print("data:")
-            #for line in data:
-            #    print(line)
-            table.addData(data, tolerances)
-        else:
-            for t in types:
-                table.addData(data, tolerances, data_type=t)
+        # the whole body is in memory already, so the data are added at once,
+        # and they do not have to be ordered by tv as chunks would require
+        table = self.App.db().table(table, columns)
+        self.addUploadedData(table, list(zip(channels, tvs, zip(*arrays))), tolerances, types)
         return Response("OK")
         
     def patch(self, req, relpath, table=None, tend=None, **args):
@@ -142,7 +142,7 @@ class DataBrowser(WPHandler):
                     dt1 = text2datetime(t1) if t1 is not None else None)
                     
     def table_data(self, req, relpath, table = None, column = None, t0 = None, t1 = None,
-                tag = None, channels = None, data_type = None, **args):
+                tag = None, channels = None, data_type = None, buckets = None, **args):
         db = self.App.db()
         t = db.table(table, [column])
         t0 = t0 or 0
@@ -160,6 +160,9 @@ class DataBrowser(WPHandler):
         data_type = data_type or None
             
         #print("t0/t1:%s/%s, channels:%s, tag:%s, data_type:%s" % (t0, t1, channels, tag, data_type))
+
+        if buckets:
+            return self.table_data_buckets(t, table, column, t0, t1, int(buckets), tag, channels, data_type)
             
         data = t.getDataInterval(t0, t1, tag=tag, data_type=data_type,
                     channel_range = channels)
@@ -195,8 +198,40 @@ class DataBrowser(WPHandler):
                 #print epoch(tv), "   last tup:", last_tup, "   this tup:", this_tup
             data_out.append((last_t, epoch(last_t), this_tup))
             data_out.append((t1, epoch(t1), this_tup))
+        data_out = [(tv, clock, vals, None, None) for tv, clock, vals in data_out]
+        resp = self.render_to_response("table_data.json", channels = chan_list, data = data_out, table = table,
+                t0 = t0, t1 = t1, intervals = False)
+        resp.content_type = "text/json"
+        return resp
+
+    def table_data_buckets(self, t, table, column, t0, t1, buckets, tag, channels, data_type):
+        # downsampled table_data: one point per time bucket at the end of the bucket, with the value
+        # at the end of the bucket and min/max of the values during the bucket as intervals
+        buckets = max(buckets, 1)
+        try:
+            stats = t.getDataIntervalBuckets(t0, t1, column, buckets, tag=tag, data_type=data_type,
+                        channel_range = channels)
+        except ValueError as e:     # t1 before t0
+            return Response(str(e), status=400)
+        chan_list = sorted(set(c for c, b, vmin, vmax, tv, v in stats))
+        index = dict((c, i) for i, c in enumerate(chan_list))
+        by_bucket = {}
+        for c, b, vmin, vmax, tv, v in stats:
+            by_bucket.setdefault(b, []).append((index[c], vmin, vmax, v))
+        last = [None] * len(chan_list)
+        data_out = []
+        if chan_list:
+            for b in range(buckets):
+                lst = by_bucket.get(b, [])
+                vmin, vmax = last[:], last[:]
+                for i, bmin, bmax, v in lst:
+                    if vmin[i] is None or (bmin is not None and bmin < vmin[i]):    vmin[i] = bmin
+                    if vmax[i] is None or (bmax is not None and bmax > vmax[i]):    vmax[i] = bmax
+                    last[i] = v
+                tb = t0 + (t1 - t0)*(b + 1)/buckets
+                data_out.append((tb, epoch(tb), last[:], vmin, vmax))
         resp = self.render_to_response("table_data.json", channels = chan_list, data = data_out, table = table,
-                t0 = t0, t1 = t1)
+                t0 = t0, t1 = t1, intervals = True)
         resp.content_type = "text/json"
         return resp
         
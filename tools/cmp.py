@@ -4,25 +4,26 @@ from timelib import text2datetime
 import sys, getopt
 
 Usage = """
-python read_data.py [options] <database name> <table_name> <t1> <t2> <columns,...>
+python cmp.py [options] <database name> <table_name> <t1> <t2> [<columns,...>]
 options:
     -h <host>
     -p <port>
     -U <user>
     -w <password>
 
+    -t <record time>
     -T <tag>    
     -d <data_type>       default = common
 """
 
 data_type = None
 tag = None
+tr = None
 dbcon = []
-t = datetime.now()
 
-opts, args = getopt.getopt(sys.argv[1:], 'h:U:w:p:t:d:')
+opts, args = getopt.getopt(sys.argv[1:], 'h:U:w:p:t:d:T:')
 
-if len(args) < 3 or args[0] == 'help':
+if len(args) < 4 or args[0] == 'help':
     print(Usage)
     sys.exit(0)
 
@@ -31,7 +32,7 @@ for opt, val in opts:
     elif opt == '-p':       dbcon.append("port=%s" % (int(val),))
     elif opt == '-U':       dbcon.append("user=%s" % (val,))
     elif opt == '-w':       dbcon.append("password=%s" % (val,))
-    elif opt == '-t':       t = text2datetime(val)
+    elif opt == '-t':       tr = text2datetime(val)
     elif opt == '-T':       tag = val
     elif opt == '-d':       data_type = val
     
@@ -42,17 +43,16 @@ t2 = text2datetime(args[3])
 
 dbcon = ' '.join(dbcon)
 tname = args[1]
-columns = args[4].split(',')
 db = ConDB(dbcon)
-table = db.table(tname, columns)
-
-data1, iov1 = table.getData(t1, data_type=data_type, tag=tag)
-data2, iov2 = table.getData(t2, data_type=data_type, tag=tag)
-
-channels = list(data2.keys())
-channels.sort()
-for c in channels:
-    if data1[c] != data2[c]:
-        print((c, iov1[c], data1[c], iov2[c], data2[c]))
-        
-            
+if len(args) > 4:
+    table = db.table(tname, args[4].split(','))
+else:
+    table = db.tableFromDB(tname)
+    if table is None:
+        print("Table %s not found" % (tname,))
+        sys.exit(1)
+
+for c, a, b in table.diff((t1, tag, tr, data_type), (t2, tag, tr, data_type)):
+    iov1, data1 = (a[0], a[1:]) if a else (None, None)
+    iov2, data2 = (b[0], b[1:]) if b else (None, None)
+    print((c, iov1, data1, iov2, data2))
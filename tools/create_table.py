@@ -3,6 +3,7 @@ import sys, getopt
 
 Usage = """
 python create_table.py [options] <database name> <table_name> <column>:<type> [...]
+python create_table.py [options] -i <database name> <table_name>
 options:
     -h <host>
     -p <port>
@@ -11,19 +12,20 @@ options:
     
     -c - force create, drop existing table
     -s - just print SQL needed to create the table without actually creating anything
+    -i - create indexes missing in an existing table
     -o <table owner>
     -R <user>,... - DB users to grant read permissions to
     -W <user>,... - DB users to grant write permissions to
 """
 
-opts, args = getopt.getopt(sys.argv[1:], 'h:U:w:p:co:R:W:s')
+opts, args = getopt.getopt(sys.argv[1:], 'h:U:w:p:co:R:W:si')
+opts = dict(opts)
 
-if len(args) < 3 or args[0] == 'help':
+if len(args) < (2 if "-i" in opts else 3) or args[0] == 'help':
     print(Usage)
     sys.exit(0)
 
 
-opts = dict(opts)
 dbcon = []
 if "-h" in opts:        dbcon.append("host=%s" % (opts["-h"],))
 if "-p" in opts:        dbcon.append("port=%s" % (int(opts["-p"]),))
@@ -48,7 +50,15 @@ for w in args[2:]:
     n,t = tuple(w.split(':',1))
     ctypes.append((n,t))
 
-if sql_only:
+if "-i" in opts:
+    db = ConDB(dbcon)
+    t = db.tableFromDB(tname)
+    if t is None:
+        print("Table %s not found" % (tname,))
+        sys.exit(1)
+    t.createIndexes()
+    print('Indexes created')
+elif sql_only:
     sql = CDTable.createSQL(tname, owner, ctypes, grants_r, grants_w)
     print(sql)
 else:
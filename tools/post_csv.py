@@ -3,16 +3,79 @@ import sys
 import urllib.request, urllib.error, urllib.parse, hashlib, random, time
 from py3 import to_str, to_bytes
 from signature import signature
-import requests
+from timelib import text2datetime_fast
+import requests, re
 
 Usage = """
-python post_csv.py [-d <data type>] <file> <table> <password> <URL>
+python post_csv.py [-d <data type>] [-b] <file> <table> <password> <URL>
+    -b      send the data as typed msgpack arrays instead of CSV text
 """
 
+QuotedField = re.compile(r'"((?:[^"]|"")*)"\s*(,|$)')
+
+def typed_value(word, strip=True):
+    # converts CSV field to number, list of numbers or text, the same way as the server does
+    if strip:   word = word.strip()
+    if not word:    return None
+    if word[0] == '[':
+        return [typed_value(w) for w in word[1:-1].split(",")]
+    try:    return int(word)
+    except ValueError:
+        try:    return float(word)
+        except ValueError:
+            return word
+
+def parse_line(line):
+    # returns [value,...] for the CSV line, the same values the server gets from it:
+    # quoted fields are taken verbatim, one trailing comma is ignored
+    out = []
+    line = line.strip()
+    while line:
+        if line[0] == '"':
+            m = QuotedField.match(line)
+            if m is None:
+                raise ValueError("Error parsing CSV line [%s]: can not find closing quote" % (line,))
+            out.append(typed_value(m.group(1).replace('""', '"'), strip=False))
+            line = line[m.end():].strip()
+        else:
+            word, _, line = line.partition(',')
+            out.append(typed_value(word))
+            line = line.strip()
+    return out
+
+def csv_to_msgpack(data):
+    # data: CSV file contents, bytes
+    # returns the CSV data as msgpack map of column arrays, as expected by the server /put
+    import msgpack
+    lines = to_str(data).split("\n")
+    columns = [x.strip() for x in lines[0].split(',')][2:]
+    channels, tvs, arrays = [], [], [[] for _ in columns]
+    tolerances = None
+    for line in lines[1:]:
+        line = line.strip()
+        if not line:    continue
+        if line.startswith('tolerance,,'):
+            tolerances = parse_line(line[len('tolerance,,'):])
+            continue
+        row = parse_line(line)
+        channels.append(row[0])
+        # times with time zone go as msgpack timestamps, the server converts others
+        # the same way as in CSV input, and the DB interprets naive ones in its time zone
+        tv = text2datetime_fast(row[1])
+        tvs.append(tv if tv.tzinfo is not None else row[1])
+        for a, x in zip(arrays, row[2:]):
+            a.append(x)
+    out = dict(columns=columns, channel=channels, tv=tvs, data=arrays)
+    if tolerances is not None:
+        out["tolerances"] = tolerances
+    return msgpack.packb(out, use_bin_type=True, datetime=True)
+
 data_type = None
-opts, args = getopt.getopt(sys.argv[1:], 'd:')
+binary = False
+opts, args = getopt.getopt(sys.argv[1:], 'd:b')
 for opt, val in opts:
     if opt == '-d':       data_type = val
+    if opt == '-b':       binary = True
 
 if not args:
     print(Usage)
@@ -30,12 +93,16 @@ url += "/put?" + url_args
 random.seed(time.time())
 salt = '%s' % (random.random(),)
 data = open(fn, 'rb').read()
+if binary:
+    data = csv_to_msgpack(data)
 sig = signature(pwd, salt, url_args, data)
 headers = {   
         'X-Salt':       salt,
         'X-Signature':  sig
         #'Expect':       "100-continue"
     }
+if binary:
+    headers['Content-Type'] = 'application/x-msgpack'
 
 try:    response = requests.post(url, data=data, headers=headers)
 except Exception as e:
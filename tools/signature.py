@@ -1,11 +1,16 @@
 import hashlib
 from py3 import to_str, to_bytes
 
-def signature(password, salt, args, data):
+def signature_digest(password, salt, args):
+        # returns the hash object to be updated with the data, for data read in chunks
         m = hashlib.md5()
         m.update(to_bytes(password))
         m.update(to_bytes(salt))
         m.update(to_bytes(args))
+        return m
+
+def signature(password, salt, args, data):
+        m = signature_digest(password, salt, args)
         m.update(to_bytes(data))
         return m.hexdigest()
 